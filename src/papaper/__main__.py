@@ -1,7 +1,13 @@
+import sys
 from multiprocessing import freeze_support
 
-from papaper.app import main
-
 if __name__ == '__main__':
     freeze_support()
-    main()
+    if len(sys.argv) > 1:
+        from papaper.cli import main
+
+        sys.exit(main())
+    else:
+        from papaper.app import main
+
+        main()
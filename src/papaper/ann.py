@@ -0,0 +1,182 @@
+import math
+import sys
+import time
+
+import faiss
+import numpy as np
+
+KINDS = ('flat', 'ivf', 'hnsw', 'ivfpq')
+COMPACT = 0.25
+
+
+def factory(kind: str, d: int, n_train: int, params: dict):
+    if kind == 'flat':
+        return 'IDMap2,Flat'
+    if kind == 'hnsw':
+        return f'HNSW{params.get("M", 32)}'
+
+    nlist = max(1, min(params.get('nlist', 1024), n_train // 39))
+    if kind == 'ivf':
+        return f'IVF{nlist},Flat'
+    if kind == 'ivfpq':
+        m = max([_ for _ in range(1, min(params.get('m', 64), d) + 1) if d % _ == 0])
+        nbits = max(1, min(params.get('nbits', 8), int(math.log2(max(n_train, 2)))))
+        return f'IVF{nlist},PQ{m}x{nbits}'
+    raise ValueError(f'unknown index type {kind}, expected one of {KINDS}')
+
+
+def train_size(params: dict):
+    if params.get('type', 'flat') in ('flat', 'hnsw'):
+        return 0
+    return params.get('train_size', 50000)
+
+
+def new_index(vectors: np.ndarray, params: dict):
+    _ = faiss.index_factory(vectors.shape[1], factory(params.get('type', 'flat'), vectors.shape[1], len(vectors), params))
+    if isinstance(_, faiss.IndexHNSW):
+        _.hnsw.efConstruction = params.get('efConstruction', 200)
+    if not _.is_trained:
+        _.train(vectors)
+    return _
+
+
+def stable(index):
+    if not isinstance(index, faiss.IndexFlat):
+        return index
+    _ = faiss.index_factory(index.d, 'IDMap2,Flat', index.metric_type)
+    if index.ntotal > 0:
+        _.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype='int64'))
+    return _
+
+
+def kind_of(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexIVF):
+        return 'ivf'
+    return 'flat'
+
+
+def set_search_params(index, nprobe: int = None, efSearch: int = None):
+    if nprobe is not None and (_ := faiss.try_extract_index_ivf(index)) is not None:
+        _.nprobe = nprobe
+    if efSearch is not None and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = efSearch
+
+
+def search(index, vectors: np.ndarray, k: int, nprobe: int = 32, efSearch: int = 128, positions: np.ndarray = None,
+           excluded: np.ndarray = None):
+    k = min(k, index.ntotal - (0 if excluded is None else len(excluded)) if positions is None else len(positions))
+    if k <= 0:
+        return np.zeros((len(vectors), 0), dtype='float32'), np.zeros((len(vectors), 0), dtype='int64')
+
+    if positions is not None:
+        selector = faiss.IDSelectorBatch(positions)
+    elif excluded is not None and len(excluded) > 0:
+        _ = faiss.IDSelectorBatch(excluded)
+        selector = faiss.IDSelectorNot(_)
+    else:
+        selector = None
+    ivf = faiss.try_extract_index_ivf(index)
+    while True:
+        if ivf is not None:
+            nprobe = min(nprobe, ivf.nlist)
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        elif isinstance(index, faiss.IndexHNSW):
+            efSearch = min(max(efSearch, k), index.ntotal)
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+
+        distances, found = index.search(vectors, k, params=params)
+        if (found >= 0).sum(axis=1).min() >= k:
+            return distances, found
+
+        if ivf is not None and nprobe < ivf.nlist:
+            nprobe *= 2
+        elif isinstance(index, faiss.IndexHNSW) and efSearch < index.ntotal:
+            efSearch *= 2
+        elif positions is not None:
+            flat = faiss.IndexFlatL2(index.d)
+            flat.add(reconstruct(index, positions.tolist()))
+            distances, found = flat.search(vectors, k)
+            return distances, positions[found]
+        else:
+            return distances, found
+
+
+def ids(index):
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map).astype('int64')
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+        _ = ivf.invlists
+        return np.sort(np.concatenate([faiss.rev_swig_ptr(_.get_ids(i), _.list_size(i)).copy()
+                                       for i in range(ivf.nlist)] + [np.zeros(0, dtype='int64')]))
+    return np.arange(index.ntotal, dtype='int64')
+
+
+def reconstruct(index, positions: list):
+    if (_ := faiss.try_extract_index_ivf(index)) is not None:
+        _.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return np.vstack([index.reconstruct(_) for _ in positions]) if len(positions) > 0 else \
+        np.zeros((0, index.d), dtype='float32')
+
+
+def add(index, vectors: np.ndarray, positions: list):
+    if isinstance(index, faiss.IndexHNSW):
+        if len(positions) > 0 and positions[0] != index.ntotal:
+            raise ValueError(f'hnsw appends at {index.ntotal}, got position {positions[0]}')
+        index.add(vectors)
+    else:
+        index.add_with_ids(vectors, np.array(positions, dtype='int64'))
+
+
+def remove(index, positions: list):
+    if isinstance(index, (faiss.IndexHNSW, faiss.IndexFlat)):
+        return False
+    index.remove_ids(np.array(positions, dtype='int64'))
+    return True
+
+
+def compact(index, tombstones: list):
+    _ = set(tombstones)
+    vectors = reconstruct(index, [i for i in range(index.ntotal) if i not in _])
+    index = faiss.clone_index(index)
+    index.reset()
+    index.add(vectors)
+    return index
+
+
+def evaluate(vectors: np.ndarray, queries: np.ndarray, k: int = 100, configs: list = None):
+    flat = new_index(vectors, dict(type='flat'))
+    add(flat, vectors, list(range(len(vectors))))
+    start = time.perf_counter()
+    _, truth = flat.search(queries, k)
+    report = [dict(type='flat', recall=1.0, ms_per_query=(time.perf_counter() - start) * 1000 / len(queries))]
+
+    for params in configs or [dict(type='ivf', nprobe=_) for _ in (1, 8, 32)] + \
+            [dict(type='hnsw', efSearch=_) for _ in (16, 64, 256)] + \
+            [dict(type='ivfpq', nprobe=_) for _ in (8, 32)]:
+        index = new_index(vectors[:train_size(params) or len(vectors)], params)
+        add(index, vectors, list(range(len(vectors))))
+        set_search_params(index, params.get('nprobe'), params.get('efSearch'))
+
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        elapsed = time.perf_counter() - start
+
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(truth, found)])
+        report.append(dict(params, recall=float(recall), ms_per_query=elapsed * 1000 / len(queries)))
+    return report
+
+
+if __name__ == '__main__':
+    index = faiss.read_index(sys.argv[1])
+    _ = reconstruct(index, ids(index).tolist())
+    rng = np.random.default_rng(0)
+    queries = _[rng.choice(len(_), min(1000, len(_)), replace=False)]
+    queries = queries + rng.normal(0, 0.05, queries.shape).astype('float32')
+    for row in evaluate(_, queries.astype('float32')):
+        print(' '.join([f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in row.items()]))
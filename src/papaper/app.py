@@ -2,13 +2,13 @@ import json
 import os
 import sys
 import threading
-from multiprocessing import Queue, Process
+import time
+from multiprocessing import Event, Queue, Process
 from pathlib import Path
-from queue import Empty
 
 import flet as ft
 
-from papaper import paper, embedding
+from papaper import ann, paper, embedding, encoder, extract, progress, tokens
 
 
 class App:
@@ -22,9 +22,12 @@ class App:
 
         self.embedding_build_p = None
         self.embedding_build_in = None
+        self.embedding_build_stop = None
 
         self.embedding_search_p = None
         self.embedding_search_in = None
+        self.embedding_search_q = Queue()
+        self.embedding_search_busy = Event()
 
         self.config_path = Path(sys.executable).parent.parent / 'config.json'
 
@@ -33,13 +36,20 @@ class App:
         else:
             self.config = {}
 
+        self.related_papers = []
         self.related_texts = []
 
+        self.channel = progress.Channel(self.log_q, (self.config_path.parent / 'logs' / 'papaper.log').as_posix())
+
     def save_config(self, **kwargs):
         self.config.update(kwargs)
         os.makedirs(self.config_path.parent, exist_ok=True)
         self.config_path.write_text(json.dumps(self.config, indent=4, ensure_ascii=False), encoding='utf-8')
 
+    def categories(self):
+        _ = [_.strip() for _ in self.categories_ui.value.split(',') if len(_.strip()) > 0]
+        return _ if len(_) > 0 else None
+
     def __call__(self, page: ft.Page):
         self.page = page
 
@@ -97,7 +107,7 @@ class App:
             self.page.snack_bar = ft.SnackBar(ft.TextField(value='''
 1. 输入关键词、检索的论文篇数、论文发表的最近年数
 2. 开始下载，论文将保存到存档目录的documents子目录，按发表年份分类
-3. 下载记录位于documents子目录下的<关键词>.json文件，重复下载将跳过已下载失败的条目，如需完全重置请删除该文件
+3. 下载记录位于documents子目录下的<关键词>.sqlite3文件，下载结束时导出为<关键词>.json，重复下载将跳过已下载成功的条目，并重试下载失败的条目，如需完全重置请删除这两个文件
 4. 不会消耗付费资源
                     ''', read_only=True, multiline=True, border=ft.InputBorder.NONE, color='white'), duration=30000)
             self.page.snack_bar.open = True
@@ -149,9 +159,17 @@ class App:
         def on_help(_):
             self.page.snack_bar = ft.SnackBar(ft.TextField(value='''
 1. 构建数据库，该过程将识别documents子目录下所有可识别的文档，文档越多构建耗时越长
-2. 数据库保存在embedding子目录下，每次构建都将覆盖旧文件
-3. 输入查询文本，在数据库中搜索相似的文本段落，按相似度排序
-4. 根据chat模型的token限制，例如GPT3-5 16k，选择合适的资源token数量，一键复制作为引用资料
+   Parser选择pypdf或pdfminer时在本进程内解析PDF，无需Java，无法解析的文档回退到tika
+   Index选择flat为精确搜索，ivf、hnsw、ivfpq为近似搜索，适合百万级以上的文本段落，仅在新建数据库时生效
+   Backend选择onnx或onnx-int8时使用ONNX Runtime在CPU上计算向量，int8为量化模型，速度更快，首次使用时导出模型
+   构建时去除每页重复的页眉、页脚和页码，并跳过完全相同或近似重复的文本段落，不再为其计算向量
+2. 数据库按年份保存在embedding/<年份>子目录下，重复构建只处理新增、修改和删除的文档，如需完全重建请删除该目录
+   Categories填写逗号分隔的年份时，只构建和搜索这些年份，留空则为全部
+3. 构建过程定期保存进度，取消后再次构建将从上次保存处继续，解析的文本缓存在texts子目录下
+4. 输入查询文本，在数据库中搜索相似的文本段落，按相似度排序，可按年份范围、标题和下载关键词筛选
+   Mode选择hybrid时同时进行关键词(BM25)和向量检索并融合排序，lexical只按关键词检索，无需加载模型，vector只按向量检索
+   结果按论文汇总排序，Score选择max取最相关段落的得分，sum累加所有命中段落的得分，MMR减少内容相似的论文
+5. 根据chat模型的token限制，例如GPT3-5 16k，选择合适的资源token数量，一键复制作为引用资料
                     ''', read_only=True, multiline=True, border=ft.InputBorder.NONE, color='white'), duration=30000)
             self.page.snack_bar.open = True
             self.page.update()
@@ -164,16 +182,54 @@ class App:
 
         def on_embedding_build(_):
             if isinstance(self.embedding_build_p, Process) and self.embedding_build_p.is_alive():
-                self.embedding_build_p.kill()
+                if self.embedding_build_stop.is_set():
+                    self.embedding_build_p.kill()
+                else:
+                    self.embedding_build_stop.set()
             else:
+                self.embedding_build_stop = Event()
                 self.embedding_build_in = {
                     'load': (Path(self.save_ui.value) / 'documents').as_posix(),
                     'embedding': (Path(self.save_ui.value) / 'embedding').as_posix(),
+                    'categories': self.categories(),
+                    'texts': (Path(self.save_ui.value) / 'texts').as_posix(),
+                    'engine': self.engine_ui.value,
+                    'index': {'type': self.index_ui.value},
+                    'model': {'backend': self.backend_ui.value},
+                    'pool': self.pool_ui.value,
+                    'stop': self.embedding_build_stop,
                 }
                 args = (self.embedding_build_in, self.log_q)
-                self.embedding_build_p = Process(target=embedding.build, args=args, daemon=True)
+                self.embedding_build_p = Process(target=embedding.build, args=args,
+                                                 daemon=self.pool_ui.value != 'process')
                 self.embedding_build_p.start()
 
+        self.embedding_tab.controls.append(bar := ft.Row())
+        _ = [ft.dropdown.Option(_) for _ in extract.ENGINES]
+        self.engine_ui = ft.Dropdown(label='Parser', options=_, value=self.config.get('engine', 'tika'), expand=1,
+                                     on_change=lambda e: self.save_config(engine=e.control.value))
+        bar.controls.append(self.engine_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in ann.KINDS]
+        self.index_ui = ft.Dropdown(label='Index', options=_, value=self.config.get('index', 'flat'), expand=1,
+                                    on_change=lambda e: self.save_config(index=e.control.value))
+        bar.controls.append(self.index_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in encoder.BACKENDS]
+        self.backend_ui = ft.Dropdown(label='Backend', options=_, value=self.config.get('backend', 'torch'), expand=1,
+                                      on_change=lambda e: self.save_config(backend=e.control.value))
+        bar.controls.append(self.backend_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in embedding.POOLS]
+        self.pool_ui = ft.Dropdown(label='Pool', options=_, value=self.config.get('pool', 'thread'), expand=1,
+                                   on_change=lambda e: self.save_config(pool=e.control.value))
+        bar.controls.append(self.pool_ui)
+
+        self.categories_ui = ft.TextField(label='Categories', hint_text='2021,2022', expand=1,
+                                          value=self.config.get('categories', ''),
+                                          on_change=lambda e: self.save_config(categories=e.control.value))
+        bar.controls.append(self.categories_ui)
+
         self.embedding_tab.controls.append(bar := ft.Row())
         self.embedding_build_ui = ft.ElevatedButton(on_click=on_embedding_build, expand=1)
         bar.controls.append(self.embedding_build_ui)
@@ -187,18 +243,64 @@ class App:
             on_change=lambda e: self.save_config(search_input=e.control.value))
         bar.controls.append(self.embedding_query_ui)
 
+        self.embedding_tab.controls.append(bar := ft.Row())
+        self.year_low_ui = ft.TextField(label='From year', expand=1, value=self.config.get('year_low', ''),
+                                        on_change=lambda e: self.save_config(year_low=e.control.value))
+        bar.controls.append(self.year_low_ui)
+
+        self.year_high_ui = ft.TextField(label='To year', expand=1, value=self.config.get('year_high', ''),
+                                         on_change=lambda e: self.save_config(year_high=e.control.value))
+        bar.controls.append(self.year_high_ui)
+
+        self.title_filter_ui = ft.TextField(label='Title contains', expand=1)
+        bar.controls.append(self.title_filter_ui)
+
+        self.keyword_filter_ui = ft.TextField(label='Downloaded with keyword', expand=1)
+        bar.controls.append(self.keyword_filter_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in embedding.MODES]
+        self.mode_ui = ft.Dropdown(label='Mode', options=_, value=self.config.get('mode', 'hybrid'), expand=1,
+                                   on_change=lambda e: self.save_config(mode=e.control.value))
+        bar.controls.append(self.mode_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in embedding.AGGREGATES]
+        self.aggregate_ui = ft.Dropdown(label='Score', options=_, value=self.config.get('aggregate', 'max'), expand=1,
+                                        on_change=lambda e: self.save_config(aggregate=e.control.value))
+        bar.controls.append(self.aggregate_ui)
+
+        _ = [ft.dropdown.Option(_) for _ in ('off', '0.9', '0.7', '0.5')]
+        self.mmr_ui = ft.Dropdown(label='MMR', options=_, value=self.config.get('mmr', 'off'), expand=1,
+                                  on_change=lambda e: self.save_config(mmr=e.control.value))
+        bar.controls.append(self.mmr_ui)
+
         def on_embedding_search(_):
-            if isinstance(self.embedding_search_p, Process) and self.embedding_search_p.is_alive():
-                self.embedding_search_p.kill()
+            if self.embedding_search_busy.is_set():
+                if isinstance(self.embedding_search_p, Process) and self.embedding_search_p.is_alive():
+                    self.embedding_search_p.kill()
+                self.embedding_search_q = Queue()
+                self.embedding_search_busy.clear()
             else:
+                if not (isinstance(self.embedding_search_p, Process) and self.embedding_search_p.is_alive()):
+                    args = (self.embedding_search_q, self.log_q, self.embedding_search_busy)
+                    self.embedding_search_p = Process(target=embedding.serve, args=args, daemon=True)
+                    self.embedding_search_p.start()
+
                 self.related_documents_ui.value = ''
                 self.embedding_search_in = {
                     'query': self.embedding_query_ui.value,
                     'embedding': (Path(self.save_ui.value) / 'embedding').as_posix(),
+                    'categories': self.categories(),
+                    'year_low': int(self.year_low_ui.value) if self.year_low_ui.value.isdigit() else None,
+                    'year_high': int(self.year_high_ui.value) if self.year_high_ui.value.isdigit() else None,
+                    'title': self.title_filter_ui.value or None,
+                    'keyword': self.keyword_filter_ui.value or None,
+                    'mode': self.mode_ui.value,
+                    'model': {'backend': self.backend_ui.value},
+                    'aggregate': self.aggregate_ui.value,
+                    'mmr': None if self.mmr_ui.value == 'off' else float(self.mmr_ui.value),
                 }
-                args = (self.embedding_search_in, self.log_q)
-                self.embedding_search_p = Process(target=embedding.search, args=args, daemon=True)
-                self.embedding_search_p.start()
+                self.embedding_search_busy.set()
+                self.embedding_search_q.put(self.embedding_search_in)
 
         self.embedding_tab.controls.append(bar := ft.Row())
         self.embedding_search_ui = ft.ElevatedButton(on_click=on_embedding_search, expand=1)
@@ -214,7 +316,8 @@ class App:
         bar.controls.append(self.reference_tokens_ui)
 
         def on_embedding_to_chat(_):
-            text, n = embedding.text_in_tokens([_[2] for _ in self.related_texts], int(self.reference_tokens_ui.value))
+            text, n = tokens.pack([_[2] for _ in self.related_texts], [_[3] for _ in self.related_texts],
+                                  int(self.reference_tokens_ui.value))
             self.chat_resource_ui.value = text
             self.log_q.put(f'[EMBEDDING] reference {n} tokens')
 
@@ -314,42 +417,64 @@ class App:
         self.log_ui = ft.ListView(expand=1, auto_scroll=True, on_scroll_interval=1, height=100)
         bar.controls.append(self.log_ui)
 
+        self.page.controls.append(bar := ft.Row())
+        self.progress_ui = ft.Text('')
+        bar.controls.append(self.progress_ui)
+
         self.page.update()
-        self.loop()
+        threading.Thread(target=self.loop, daemon=True).start()
 
-    def loop(self):
+    def buttons(self):
         if isinstance(self.paper_p, Process) and self.paper_p.is_alive():
             self.paper_start_ui.text = 'Cancel'
         else:
             self.paper_start_ui.text = 'Download papers'
 
         if isinstance(self.embedding_build_p, Process) and self.embedding_build_p.is_alive():
-            self.embedding_build_ui.text = 'Cancel'
+            self.embedding_build_ui.text = 'Force quit' if self.embedding_build_stop.is_set() else 'Cancel'
         else:
             self.embedding_build_ui.text = 'Build database'
 
-        if isinstance(self.embedding_search_p, Process) and self.embedding_search_p.is_alive():
+        if self.embedding_search_busy.is_set():
             self.embedding_search_ui.text = 'Cancel'
         else:
             self.embedding_search_ui.text = 'Search related documents'
 
-        try:
-            log: str = self.log_q.get(block=False)
-            if isinstance(log, dict):
-                if _ := log.get('related documents', None):
-                    self.related_texts = _
-                    self.related_documents_ui.value = '\n'.join({f'{_[0]} {_[1]}' for _ in self.related_texts})
-            else:
-                self.log_ui.controls.append(ft.Text(log))
+        return self.paper_start_ui.text, self.embedding_build_ui.text, self.embedding_search_ui.text
 
-                if log.startswith('ERROR'):
+    def loop(self):
+        state = None
+        while True:
+            changed = state != (state := self.buttons())
+
+            lines, messages = self.channel.drain()
+            for log in messages:
+                if (_ := log.get('related papers', None)) is not None:
+                    self.related_papers = _ if log['offset'] == 0 else self.related_papers + _
+                    self.related_texts = [(paper['category'], paper['title'], _['text'], _['tokens'])
+                                          for paper in self.related_papers for _ in paper['passages']]
+                    self.related_documents_ui.label = f'Related documents by {log.get("score", "rrf")}'
+                    self.related_documents_ui.value = '\n'.join(
+                        f'{_["score"]:.4f} {_["category"]} {_["title"]}' for _ in self.related_papers)
+
+            for log in lines:
+                if '] ERROR' in log:
                     self.page.dialog.content = ft.Text(log)
                     self.page.dialog.open = True
-        except Empty:
-            pass
 
-        self.page.update()
-        threading.Timer(0.1, self.loop).start()
+            if len(lines) > 0:
+                self.log_ui.controls.extend(ft.Text(_) for _ in lines)
+                del self.log_ui.controls[:-self.channel.lines.maxlen]
+
+            if self.channel.due():
+                self.progress_ui.value = self.channel.status()
+                changed = True
+
+            if changed or len(lines) > 0 or len(messages) > 0:
+                self.page.update()
+
+            if self.channel.drained < self.channel.batch:
+                time.sleep(0.1)
 
 
 def main():
@@ -0,0 +1,220 @@
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+
+from papaper import ann, chunking, embedding, encoder, extract, tokens
+
+
+LICENSE = ['This article is distributed under the terms of the Creative Commons Attribution License, which',
+           'permits unrestricted use, distribution, and reproduction in any medium, provided the original author',
+           'and source are credited. The authors declare that they have no known competing financial interests.']
+
+
+class HashEmbeddings(Embeddings):
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def embed_documents(self, texts: list):
+        vectors = np.zeros((len(texts), self.dim), dtype='float32')
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                _ = zlib.crc32(word.encode('utf-8'))
+                vectors[i, _ % self.dim] += 1 if _ & 1 << 31 else -1
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+        return vectors.tolist()
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+
+def write_pdf(filename: str, lines: list, per_page: int = 60):
+    def escape(_):
+        return _.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    pages = [lines[i:i + per_page] for i in range(0, len(lines), per_page)] or [[]]
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Type /Pages /Kids [{" ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))}] '
+               f'/Count {len(pages)} >>',
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, page in enumerate(pages):
+        _ = 'BT /F1 10 Tf 12 TL 50 800 Td ' + ' '.join(f'({escape(_)}) Tj T*' for _ in page) + ' ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {5 + 2 * i} 0 R '
+                       f'/Resources << /Font << /F1 3 0 R >> >> >>')
+        objects.append(f'<< /Length {len(_)} >>\nstream\n{_}\nendstream')
+
+    content, offsets = b'%PDF-1.4\n', []
+    for i, _ in enumerate(objects):
+        offsets.append(len(content))
+        content += f'{i + 1} 0 obj\n{_}\nendobj\n'.encode('latin-1')
+    xref = len(content)
+    content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    content += ''.join(f'{_:010d} 00000 n \n' for _ in offsets).encode('latin-1')
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    Path(filename).write_bytes(content)
+
+
+def corpus(root: str, files: int = 100, words: int = 2000, years: int = 5, vocabulary: int = 5000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    vocabulary = [''.join(rng.choice(letters, rng.integers(2, 10))) for _ in range(vocabulary)]
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+
+    filenames = []
+    for i in range(files):
+        _ = Path(root) / str(2024 - i % years)
+        _.mkdir(parents=True, exist_ok=True)
+        text = ' '.join(rng.choice(vocabulary, words, p=weights))
+        lines, line = [], ''
+        for word in text.split():
+            if len(line) + len(word) > 90:
+                lines.append(line)
+                line = ''
+            line = f'{line} {word}' if line else word
+        lines += [line, '', *LICENSE]
+        header = [f'Synthetic Journal of Benchmarks {2024 - i % years}, Vol. {i % 12 + 1}', '']
+        lines = sum([header + lines[j:j + 50] + ['', str(j // 50 + 1)] for j in range(0, len(lines), 50)], [])
+        write_pdf((_ / f'paper{i}.pdf').as_posix(), lines, len(header) + 52)
+        filenames.append((_ / f'paper{i}.pdf').as_posix())
+    return filenames
+
+
+def timed(report: dict, name: str, fn, items: int = None):
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    report['stages'][name] = dict(seconds=seconds)
+    if items is not None:
+        report['stages'][name].update(items=items, rate=items / seconds if seconds > 0 else None)
+    return result
+
+
+def latency(report: dict, name: str, fn, queries: np.ndarray):
+    _ = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query[None])
+        _.append(time.perf_counter() - start)
+    _ = np.array(_) * 1000
+    report['stages'][name] = dict(seconds=float(_.sum() / 1000), items=len(queries), p50_ms=float(np.median(_)),
+                                  p95_ms=float(np.percentile(_, 95)), max_ms=float(_.max()))
+
+
+def run(root: str, files: int = 100, words: int = 2000, years: int = 5, engine: str = 'pypdf', model: str = None,
+        kinds: tuple = ('flat',), ks: tuple = (1, 10, 100), n_queries: int = 100, batch_size: int = 256,
+        budget: int = 2500, backend: str = 'torch', threads: int = None):
+    report = dict(created=time.strftime('%Y-%m-%dT%H:%M:%S'), python=sys.version.split()[0],
+                  platform=platform.platform(), faiss=faiss.__version__, numpy=np.__version__,
+                  params=dict(files=files, words=words, years=years, engine=engine, model=model or 'default',
+                              backend=backend, threads=threads, kinds=list(kinds), ks=list(ks), queries=n_queries,
+                              batch_size=batch_size),
+                  stages={})
+
+    filenames = timed(report, 'corpus', lambda: corpus((Path(root) / 'documents').as_posix(), files, words, years),
+                      files)
+    contents = timed(report, 'extract', lambda: [extract.extract_text(_, engine) for _ in filenames], files)
+    contents = timed(report, 'boilerplate', lambda: [chunking.clean(_)[0] for _ in contents], files)
+    chunks = timed(report, 'chunking', lambda: sum([chunking.split(_) for _ in contents], []),
+                   sum(len(_) for _ in contents))
+    report['stages']['chunking']['chunks'] = len(chunks)
+    dedup = chunking.Deduplicator()
+    chunks = timed(report, 'dedup', lambda: dedup.filter(chunks)[0], len(chunks))
+    report['stages']['dedup'].update(exact=dedup.exact, near=dedup.near, kept=dedup.kept)
+    timed(report, 'parse_file', lambda: [embedding.parse_file(_, engine=engine) for _ in filenames], files)
+
+    try:
+        counts = timed(report, 'tokens.count', lambda: tokens.count(chunks), len(chunks))
+        timed(report, 'tokens.pack', lambda: tokens.pack(chunks[:100], counts[:100], budget), 100)
+        timed(report, 'tokens.pack.uncounted', lambda: tokens.pack(chunks[:100], [None] * 100, budget), 100)
+    except Exception as e:
+        report['stages']['tokens.count'] = dict(error=str(e))
+
+    if model == 'hash':
+        embeddings = HashEmbeddings()
+    else:
+        cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+        embeddings = timed(report, 'model', lambda: encoder.create(
+            dict(backend=backend, model=model, threads=threads), cache))
+
+    vectors = timed(report, 'embedding', lambda: np.array(sum(
+        [embeddings.embed_documents(chunks[i:i + batch_size]) for i in range(0, len(chunks), batch_size)], []),
+        dtype='float32'), len(chunks))
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    queries = (queries + rng.normal(0, 0.05, queries.shape)).astype('float32')
+
+    docs = [Document(page_content=_, metadata=dict(category='bench', title=f'paper{i}', tokens=None))
+            for i, _ in enumerate(chunks)]
+    ids = embedding.chunk_ids('bench/paper', len(chunks))
+    for kind in kinds:
+        shard = embedding.Shard((Path(root) / 'embedding' / kind / 'bench').as_posix(), embeddings, {'type': kind})
+
+        def _():
+            shard.pending.append((docs, vectors.tolist(), ids))
+            shard.flush(final=True)
+
+        timed(report, f'index.{kind}', _, len(chunks))
+        timed(report, f'save.{kind}', lambda: shard.save({'bench/paper': {}}, final=True), len(chunks))
+        report['stages'][f'save.{kind}']['bytes'] = shard.size()
+        shard = timed(report, f'open.{kind}', lambda: embedding.Shard(shard.path, embeddings, {}).open())
+
+        for k in ks:
+            latency(report, f'search.{kind}.k{k}', lambda _: shard.search(_, k, 32, 128), queries)
+            timed(report, f'search.{kind}.k{k}.batch', lambda: shard.search(queries, k, 32, 128), len(queries))
+    return report
+
+
+def compare(old: dict, new: dict):
+    rows = []
+    for name, _ in new['stages'].items():
+        if 'seconds' in _ and 'seconds' in old['stages'].get(name, {}):
+            before = old['stages'][name]['seconds']
+            rows.append((name, before, _['seconds'], _['seconds'] / before if before > 0 else None))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m papaper.bench', description='Time each build and search stage '
+                                                                               'on a synthetic PDF corpus.')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--words', type=int, default=2000, help='words per file')
+    parser.add_argument('--years', type=int, default=5, help='number of year subdirectories')
+    parser.add_argument('--engine', choices=extract.ENGINES, default='pypdf')
+    parser.add_argument('--model', help='sentence-transformers model name or local path, hash for a model-free run')
+    parser.add_argument('--backend', choices=encoder.BACKENDS, default='torch')
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--index', nargs='+', choices=ann.KINDS, default=['flat'])
+    parser.add_argument('-k', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--root', help='keep the corpus and databases here instead of a temporary directory')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', help='previous report to compare with')
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='papaper-bench-')
+    try:
+        report = run(root, args.files, args.words, args.years, args.engine, args.model, tuple(args.index),
+                     tuple(args.k), args.queries, args.batch_size, backend=args.backend, threads=args.threads)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    Path(args.output).write_text(json.dumps(report, indent=4), encoding='utf-8')
+    for name, _ in report['stages'].items():
+        print(name, ' '.join([f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in _.items()]))
+
+    if args.compare is not None:
+        for name, before, after, ratio in compare(json.loads(Path(args.compare).read_text(encoding='utf-8')), report):
+            print(f'{name} {before:.4f}s -> {after:.4f}s x{ratio:.2f}' if ratio is not None else name)
@@ -0,0 +1,129 @@
+import hashlib
+import re
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+DEFAULTS = dict(size=200, overlap=20, unit='chars', boilerplate=3, dedup='minhash', threshold=0.8)
+DEDUP = ('none', 'exact', 'minhash')
+SEPARATORS = ['\n\n', '\n', r'(?<=[.?!;])\s+', r'\s+', '']
+PRIME = (1 << 31) - 1
+
+
+def normalize(line: str):
+    return re.sub(r'\s+', ' ', re.sub(r'\d+', '#', line.lower())).strip()
+
+
+def clean(content: str, repeats: int = 3, edge: int = 3):
+    pages = [_.splitlines() for _ in content.split('\f')]
+    keys = [[normalize(_) for _ in _] for _ in pages]
+    edges, numbers = [], []
+    for _ in keys:
+        _ = [i for i, key in enumerate(_) if len(key) > 0]
+        edges.append(set(_[:edge] + _[-edge:]))
+        numbers.append(set(_[:1] + _[-1:]) if len(pages) > 1 else set())
+    counts = Counter([_ for page, _ in zip(keys, edges)
+                      for _ in {page[i] for i in _ if len(page[i]) <= 200 and any(c.isalpha() for c in page[i])}])
+
+    kept, removed = [], 0
+    for lines, page, _, number in zip(pages, keys, edges, numbers):
+        drop = {i for i in _ if counts[page[i]] >= repeats}
+        drop |= {i for i in number if len(page[i].strip('#-–.|/ ')) == 0}
+        kept.append('\n'.join([line for i, line in enumerate(lines) if i not in drop]))
+        removed += len(drop)
+    return '\n'.join(kept), removed
+
+
+@lru_cache(maxsize=None)
+def splitter(size: int = 200, overlap: int = 20, unit: str = 'chars'):
+    if unit == 'tokens':
+        from papaper import tokens
+
+        length = lambda _: len(tokens.encoding().encode_ordinary(_))
+    elif unit == 'chars':
+        length = len
+    else:
+        raise ValueError(f'unknown chunk unit {unit}, expected chars or tokens')
+
+    return RecursiveCharacterTextSplitter(chunk_size=size, chunk_overlap=overlap, length_function=length,
+                                          separators=SEPARATORS, is_separator_regex=True)
+
+
+def split(content: str, size: int = 200, overlap: int = 20, unit: str = 'chars'):
+    return splitter(size, overlap, unit).split_text(content)
+
+
+class Deduplicator:
+    def __init__(self, mode: str = 'minhash', threshold: float = 0.8, permutations: int = 64, bands: int = 16,
+                 shingle: int = 3, seed: int = 0):
+        if mode not in DEDUP:
+            raise ValueError(f'unknown dedup {mode}, expected one of {DEDUP}')
+
+        self.mode = mode
+        self.threshold = threshold
+        self.rows = permutations // bands
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, permutations, dtype='uint64')
+        self.b = rng.integers(0, PRIME, permutations, dtype='uint64')
+        self.hashes = {}
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures, self.keys = [], []
+        self.kept, self.exact, self.near = 0, 0, 0
+
+    def signature(self, text: str):
+        words = re.findall(r'\w+', text.lower()) or ['']
+        shingles = {' '.join(words[i:i + self.shingle]) for i in range(max(1, len(words) - self.shingle + 1))}
+        _ = np.array([zlib.crc32(_.encode('utf-8')) for _ in shingles], dtype='uint64')
+        return ((np.outer(_, self.a) + self.b) % PRIME).min(axis=0).astype('uint32')
+
+    def fingerprint(self, text: str):
+        if self.mode == 'none':
+            return None, None
+        digest = hashlib.blake2b(' '.join(text.lower().split()).encode('utf-8'), digest_size=16).digest()
+        return digest, self.signature(text) if self.mode == 'minhash' else None
+
+    def bands(self, signature: np.ndarray):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(len(self.buckets))]
+
+    def owner(self, digest: bytes, signature: np.ndarray = None):
+        if digest is None:
+            return None
+        if digest in self.hashes:
+            self.exact += 1
+            return self.hashes[digest]
+
+        if signature is not None and self.mode == 'minhash':
+            candidates = {_ for bucket, key in zip(self.buckets, self.bands(signature)) for _ in bucket.get(key, ())}
+            for _ in sorted(candidates):
+                if (self.signatures[_] == signature).mean() >= self.threshold:
+                    self.near += 1
+                    return self.keys[_]
+        return None
+
+    def add(self, key: str, digest: bytes, signature: np.ndarray = None):
+        if digest is None:
+            return
+        self.hashes.setdefault(digest, key)
+        if signature is not None and self.mode == 'minhash':
+            for bucket, _ in zip(self.buckets, self.bands(signature)):
+                bucket.setdefault(_, []).append(len(self.signatures))
+            self.signatures.append(signature)
+            self.keys.append(key)
+
+    def filter(self, texts: list, key: str = ''):
+        kept, fingerprints, owners = [], [], set()
+        for text in texts:
+            digest, signature = self.fingerprint(text)
+            if (_ := self.owner(digest, signature)) is not None:
+                if _ != key:
+                    owners.add(_)
+                continue
+            self.add(key, digest, signature)
+            self.kept += 1
+            kept.append(text)
+            fingerprints.append((digest, signature))
+        return kept, fingerprints, sorted(owners)
@@ -0,0 +1,177 @@
+import argparse
+import json
+import signal
+import sys
+import threading
+from pathlib import Path
+
+from papaper import ann, chunking, embedding, encoder, extract
+
+
+class JsonLines:
+    def __init__(self, out=None):
+        self.out = sys.stdout if out is None else out
+        self.failed = False
+
+    def put(self, _):
+        if isinstance(_, str):
+            self.failed = self.failed or '] ERROR' in _
+            _ = {'log': _}
+        self.out.write(json.dumps(_, ensure_ascii=False) + '\n')
+        self.out.flush()
+
+
+def categories(_: str):
+    _ = [_.strip() for _ in (_ or '').split(',') if len(_.strip()) > 0]
+    return _ if len(_) > 0 else None
+
+
+def model(args):
+    return {'backend': args.backend, 'batch_size': args.embed_batch_size, 'threads': args.threads}
+
+
+def download(args, log_q: JsonLines):
+    from papaper import paper
+
+    paper.main({
+        'save': (Path(args.save) / 'documents').as_posix(),
+        'keyword': args.keyword,
+        'n_papers': args.papers,
+        'n_years': args.years,
+        'workers': args.workers,
+        'retries': args.retries,
+        'interval': args.interval,
+    }, log_q)
+
+
+def build(args, log_q: JsonLines):
+    stop = threading.Event()
+
+    def interrupt(*_):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        stop.set()
+
+    signal.signal(signal.SIGINT, interrupt)
+    message = {
+        'load': (Path(args.save) / 'documents').as_posix(),
+        'embedding': (Path(args.save) / 'embedding').as_posix(),
+        'categories': categories(args.categories),
+        'texts': (Path(args.save) / 'texts').as_posix(),
+        'engine': args.engine,
+        'index': {'type': args.index},
+        'pool': args.pool,
+        'batch_size': args.batch_size,
+        'stop': stop,
+        'profile': args.profile,
+        'chunking': dict(size=args.chunk_size, overlap=args.chunk_overlap, unit=args.chunk_unit,
+                         boilerplate=args.boilerplate, dedup=args.dedup),
+        'model': model(args),
+    }
+    if args.workers is not None:
+        message['workers'] = args.workers
+    embedding.build(message, log_q)
+
+
+def search(args, log_q: JsonLines):
+    queries = [] if args.query is None else [args.query]
+    if args.queries is not None:
+        _ = sys.stdin.read() if args.queries == '-' else Path(args.queries).read_text(encoding='utf-8')
+        queries += [line.strip() for line in _.splitlines() if len(line.strip()) > 0]
+
+    message = {
+        'queries': queries,
+        'embedding': (Path(args.save) / 'embedding').as_posix(),
+        'categories': categories(args.categories),
+        'year_low': args.year_low,
+        'year_high': args.year_high,
+        'title': args.title,
+        'keyword': args.keyword,
+        'k': args.k,
+        'mode': args.mode,
+        'aggregate': args.aggregate,
+        'mmr': args.mmr,
+        'passages': args.passages,
+        'page': args.page,
+        'batch_size': args.batch_size,
+        'profile': args.profile,
+        'model': model(args),
+    }
+    embedding.search_batch(message, log_q)
+
+
+def parser():
+    root = argparse.ArgumentParser(prog='papaper', description='Download papers, build and search the database '
+                                                               'without the GUI, writing JSON lines to stdout.')
+    root.add_argument('--save', required=True, help='save directory, as in the Config tab')
+    commands = root.add_subparsers(dest='command', required=True)
+
+    _ = commands.add_parser('download', help='search Google Scholar and download papers')
+    _.add_argument('keyword')
+    _.add_argument('--papers', type=int, default=10)
+    _.add_argument('--years', type=int, default=10)
+    _.add_argument('--workers', type=int, default=4)
+    _.add_argument('--retries', type=int, default=3)
+    _.add_argument('--interval', type=float, default=1.0)
+    _.set_defaults(run=download)
+
+    _ = commands.add_parser('build', help='build or update the database, Ctrl-C stops at the next checkpoint')
+    _.add_argument('--categories', help='comma separated, all if omitted')
+    _.add_argument('--engine', choices=extract.ENGINES, default='tika')
+    _.add_argument('--index', choices=ann.KINDS, default='flat')
+    _.add_argument('--workers', type=int, default=None)
+    _.add_argument('--pool', choices=embedding.POOLS, default='thread',
+                   help='parse in threads or in processes, processes avoid the GIL for pypdf and pdfminer')
+    _.add_argument('--batch-size', type=int, default=256)
+    _.add_argument('--chunk-size', type=int, default=chunking.DEFAULTS['size'])
+    _.add_argument('--chunk-overlap', type=int, default=chunking.DEFAULTS['overlap'])
+    _.add_argument('--chunk-unit', choices=('chars', 'tokens'), default=chunking.DEFAULTS['unit'])
+    _.add_argument('--boilerplate', type=int, default=chunking.DEFAULTS['boilerplate'],
+                   help='drop lines repeated this many times in a document, 0 to keep all')
+    _.add_argument('--dedup', choices=chunking.DEDUP, default=chunking.DEFAULTS['dedup'])
+    _.add_argument('--backend', choices=encoder.BACKENDS, default='torch',
+                   help='onnx and onnx-int8 run the same model with ONNX Runtime, exported on first use')
+    _.add_argument('--embed-batch-size', type=int, default=encoder.DEFAULTS['batch_size'],
+                   help='texts per forward pass of the model')
+    _.add_argument('--threads', type=int, help='CPU threads for the model, all cores if omitted')
+    _.add_argument('--profile', help='directory for a cProfile dump of this run')
+    _.set_defaults(run=build)
+
+    _ = commands.add_parser('search', help='search similar documents for one query or a file of queries')
+    _.add_argument('query', nargs='?')
+    _.add_argument('--queries', help='file with one query per line, - for stdin')
+    _.add_argument('--categories', help='comma separated, all if omitted')
+    _.add_argument('--year-low', type=int)
+    _.add_argument('--year-high', type=int)
+    _.add_argument('--title')
+    _.add_argument('--keyword')
+    _.add_argument('-k', type=int, default=100)
+    _.add_argument('--mode', choices=embedding.MODES, default='hybrid',
+                   help='lexical answers from the BM25 index without loading the model')
+    _.add_argument('--aggregate', choices=embedding.AGGREGATES, default='max',
+                   help='paper score from the max or sum of its chunk scores, which are cosine similarity in '
+                        'vector mode, negated BM25 in lexical mode and reciprocal rank fusion in hybrid mode')
+    _.add_argument('--mmr', type=float, help='MMR trade-off between relevance 1 and diversity 0, off if omitted')
+    _.add_argument('--passages', type=int, default=3, help='best passages kept per paper')
+    _.add_argument('--page', type=int, default=20, help='papers per output line')
+    _.add_argument('--batch-size', type=int, default=64)
+    _.add_argument('--backend', choices=encoder.BACKENDS, default='torch',
+                   help='onnx and onnx-int8 run the same model with ONNX Runtime, exported on first use')
+    _.add_argument('--embed-batch-size', type=int, default=encoder.DEFAULTS['batch_size'],
+                   help='texts per forward pass of the model')
+    _.add_argument('--threads', type=int, help='CPU threads for the model, all cores if omitted')
+    _.add_argument('--profile', help='directory for a cProfile dump of this run')
+    _.set_defaults(run=search)
+
+    return root
+
+
+def main(argv: list = None):
+    root = parser()
+    args = root.parse_args(argv)
+    if args.command == 'search' and args.query is None and args.queries is None:
+        root.error('search needs a query or --queries')
+
+    log_q = JsonLines()
+    args.run(args, log_q)
+    return 1 if log_q.failed else 0
@@ -0,0 +1,196 @@
+import os
+import re
+import threading
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import Queue
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from papaper import progress
+from papaper.store import Library, PaperStore, SearchCache, doi_of, file_digest, pub_key
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
+
+
+class RateLimiter:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next = {}
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc or url
+        with self.lock:
+            now = time.monotonic()
+            _ = max(now, self.next.get(host, now))
+            self.next[host] = _ + self.interval
+        time.sleep(_ - now)
+
+
+def retry(fn, retries: int, backoff: float):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            warnings.warn(f'RETRY {attempt + 1} / {retries} {e}')
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download_file(url: str, filename: str, limiter: RateLimiter = None, timeout: float = 60):
+    part = Path(f'{filename}.part')
+    offset = part.stat().st_size if part.exists() else 0
+
+    headers = {'User-Agent': USER_AGENT}
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+
+    if limiter is not None:
+        limiter.wait(url)
+
+    os.makedirs(part.parent, exist_ok=True)
+    with urlopen(Request(url, headers=headers), timeout=timeout) as r:
+        with open(part, 'ab' if r.status == 206 else 'wb') as f:
+            while block := r.read(1 << 16):
+                f.write(block)
+
+    with open(part, 'rb') as f:
+        if f.read(5) != b'%PDF-':
+            part.unlink()
+            raise ValueError(f'not a pdf {url}')
+
+    os.replace(part, filename)
+
+
+def fetch(paper: dict, filename: str, resolve, limiter: RateLimiter, retries: int, backoff: float):
+    def _():
+        limiter.wait('resolve')
+        download_file(resolve(paper), filename, limiter)
+
+    retry(_, retries, backoff)
+
+
+def resume(search_pubs, position: int, page: int = 10):
+    pubs = search_pubs(position - position % page)
+    for _ in range(position % page):
+        if next(pubs, None) is None:
+            break
+    return pubs
+
+
+def run(pubs, fill, resolve, metadata: PaperStore, save_in: Path, n_papers: int, log_q: Queue,
+        workers: int = 4, retries: int = 3, backoff: float = 1.0, interval: float = 1.0, retry_failed: bool = True,
+        library: Library = None, keyword: str = None, cache: SearchCache = None):
+    limiter = RateLimiter(interval)
+    jobs = {}
+
+    def submit(pub_year: str, title: str, paper: dict):
+        if library is not None and (_ := library.find(doi_of(paper), title)) is not None:
+            if (save_in / _).exists():
+                log_q.put(f'[PAPER] skip duplicate {pub_year} {title} of {_}')
+                library.add(_, keyword=keyword)
+                metadata.set_download(pub_year, title, 'duplicate')
+                return
+            library.remove(_)
+
+        log_q.put(f'[PAPER] try download {pub_year} {title}')
+        path = f'{pub_year}/' + re.sub(r'[\\/:*?"<>|]+', '', title) + '.pdf'
+        jobs[pool.submit(fetch, paper, (save_in / path).as_posix(), resolve, limiter, retries, backoff)] = \
+            pub_year, title, paper, path
+
+    def collect(n: int):
+        while len(jobs) > n:
+            done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for future in done:
+                pub_year, title, paper, path = jobs.pop(future)
+                try:
+                    future.result()
+                    download = 'succeeded'
+                except Exception as e:
+                    warnings.warn(f'SCIHUB {e}')
+                    download = 'failed'
+
+                if download == 'succeeded' and library is not None:
+                    sha256 = file_digest((save_in / path).as_posix())
+                    if (_ := library.find(sha256=sha256)) not in (None, path) and (save_in / _).exists():
+                        os.remove(save_in / path)
+                        library.add(_, keyword=keyword)
+                        download = 'duplicate'
+                    else:
+                        library.add(path, sha256, doi_of(paper), title, keyword)
+
+                log_q.put(f'[PAPER] try download {download} {pub_year} {title}')
+                metadata.set_download(pub_year, title, download)
+
+    def search(paper: dict, advance: bool = False):
+        try:
+            key = pub_key(paper)
+            known = cache.get(key) if cache is not None else None
+            if cache is not None:
+                if known is None:
+                    cache.put(key, paper)
+                if advance:
+                    cache.advance()
+
+            if known is not None and known[1] is not None:
+                paper = known[1]
+            elif (_ := (paper['bib'].get('pub_year'), paper['bib'].get('title'))) in metadata:
+                log_q.put(f'[PAPER] skip {_[0]} {_[1]}')
+                if cache is not None:
+                    cache.put(key, filled={k: v for k, v in metadata.get(*_).items() if k != 'download'})
+                return
+            else:
+                fill(paper)
+                if cache is not None:
+                    cache.put(key, filled=paper)
+
+            pub_year = paper['bib']['pub_year']
+            title = paper['bib']['title']
+
+            if (pub_year, title) in metadata:
+                log_q.put(f'[PAPER] skip {pub_year} {title}')
+                metadata.put(pub_year, title, paper.copy())
+            else:
+                metadata.put(pub_year, title, paper.copy())
+                submit(pub_year, title, paper)
+        except Exception as e:
+            warnings.warn(f'SCHOLARLY {e}')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if retry_failed:
+            for pub_year, title, paper in metadata.retryable():
+                collect(2 * workers)
+                submit(pub_year, title, paper)
+
+        for paper in cache.pending() if cache is not None else []:
+            if len(metadata) >= n_papers:
+                break
+            collect(2 * workers - 1)
+            search(paper)
+
+        searched = len(metadata)
+        progress.put(log_q, 'PAPER', searched, n_papers)
+
+        while searched < n_papers:
+            collect(2 * workers - 1)
+
+            try:
+                log_q.put('[PAPER] search next')
+                paper = next(pubs)
+            except StopIteration:
+                log_q.put('[PAPER] no more search results')
+                break
+            except Exception as e:
+                warnings.warn(f'SCHOLARLY {e}')
+                continue
+
+            search(paper, advance=True)
+
+            searched = len(metadata)
+            progress.put(log_q, 'PAPER', searched, n_papers)
+
+        collect(0)
@@ -1,106 +1,965 @@
-# import hashlib
+import json
 import os
+import pickle
+import re
+import shutil
+import sqlite3
 import sys
-from multiprocessing import Queue
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Queue, current_process
 from pathlib import Path
 
-import tiktoken
-from langchain.embeddings import HuggingFaceEmbeddings
+import faiss
+import numpy as np
+from langchain.embeddings.base import Embeddings
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import FAISS
-from tika import parser
 
+from papaper import ann, chunking, encoder, extract, progress, textcache, tokens
+from papaper.metrics import Metrics
+from papaper.store import LIBRARY, Library, file_digest
 
-def parse_file(filename: str):
-    parsed = parser.from_file(filename)
-    content = parsed['content']
+MANIFEST = 'manifest.json'
+METADATA = 'metadata.sqlite3'
+METRICS = 'metrics.jsonl'
+MODES = ('hybrid', 'vector', 'lexical')
+SCORES = dict(hybrid='rrf', vector='similarity', lexical='bm25')
+AGGREGATES = ('max', 'sum')
+POOLS = ('thread', 'process')
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=200,
-        chunk_overlap=20,
-        length_function=len,
-    )
 
-    texts = text_splitter.split_text(content)
-    return texts
+def parse_file(filename: str, sha256: str = None, texts: str = None, engine: str = 'tika', metrics: Metrics = None,
+               chunk_params: dict = None):
+    metrics = Metrics() if metrics is None else metrics
+    chunk_params = dict(chunking.DEFAULTS, **(chunk_params or {}))
+    content = None
+    if texts is not None and sha256 is not None:
+        with metrics.timer('cache.get') as _:
+            content = textcache.get(texts, f'{sha256}.{engine}')
+            _.update(items=int(content is not None), bytes=len(content or ''))
 
+    if content is None:
+        start = time.perf_counter()
+        content, used = extract.extract(filename, engine)
+        metrics.record(f'extract.{used}', time.perf_counter() - start, 1, os.path.getsize(filename))
+        if used != engine:
+            metrics.record('extract.fallback', 0, 1)
+        if texts is not None and sha256 is not None:
+            with metrics.timer('cache.put', 1, len(content)):
+                textcache.put(texts, f'{sha256}.{engine}', content)
 
-def build(message: dict, log_q: Queue):
+    if chunk_params['boilerplate'] > 0:
+        with metrics.timer('boilerplate', 0, len(content)) as _:
+            content, _['items'] = chunking.clean(content, chunk_params['boilerplate'])
+
+    with metrics.timer('split', 0, len(content)) as _:
+        chunks = chunking.split(content, chunk_params['size'], chunk_params['overlap'], chunk_params['unit'])
+        _['items'] = len(chunks)
+    return chunks
+
+
+def _parse_file(filename: str, sha256: str = None, texts: str = None, engine: str = 'tika', chunk_params: dict = None):
+    metrics = Metrics()
     try:
-        load = message['load']
-        embedding = message['embedding']
-        cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+        return parse_file(filename, sha256, texts, engine, metrics, chunk_params), metrics.stages
+    except Exception as e:
+        return e, metrics.stages
 
-        log_q.put('[EMBEDDING] initialize')
 
-        total = 0
-        for subdir in os.listdir(load):
-            subdir = Path(load) / subdir
-            if not subdir.is_dir():
-                continue
-            for _ in os.listdir(subdir.as_posix()):
-                total += 1
+def parse_files(filenames: list, workers: int, pool: str = 'thread', sha256s: list = None, texts: str = None,
+                engine: str = 'tika', metrics: Metrics = None, chunk_params: dict = None):
+    def result(future):
+        _, stages = future.result()
+        if metrics is not None:
+            metrics.merge(stages)
+        return _
 
-        docs = []
-        parsed = 0
-        for subdir in os.listdir(load):
-            subdir = Path(load) / subdir
-            if not subdir.is_dir():
-                continue
+    executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    with executor(max_workers=workers) as _:
+        pending = deque()
+        try:
+            for filename, sha256 in zip(filenames, sha256s or [None] * len(filenames)):
+                pending.append(_.submit(_parse_file, filename, sha256, texts, engine, chunk_params))
+                if len(pending) >= 2 * workers:
+                    yield result(pending.popleft())
+            while len(pending) > 0:
+                yield result(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
 
-            for _ in os.listdir(subdir.as_posix()):
-                _ = subdir / _
 
-                texts = parse_file(_.as_posix())
-                docs += [Document(page_content=t, metadata=dict(category=_.parent.name, title=_.name)) for t in texts]
+def load_manifest(embedding: str):
+    _ = Path(embedding) / MANIFEST
+    if not _.exists():
+        return {}
+    manifest = json.loads(_.read_text(encoding='utf-8'))
+    if (Path(embedding) / 'index.faiss').exists() or all(_.get('chunks', 0) == 0 for _ in manifest.values()):
+        return manifest
+    return {}
 
-                log_q.put(f'[EMBEDDING] {parsed + 1} / {total} parsed {len(texts)} from {_.parent.name} {_.name}')
-                parsed += 1
 
-        log_q.put(f'[EMBEDDING] wait for building database')
-        _ = FAISS.from_documents(docs, HuggingFaceEmbeddings(cache_folder=cache))
+def save_manifest(embedding: str, manifest: dict):
+    os.makedirs(embedding, exist_ok=True)
+    _ = Path(embedding) / MANIFEST
+    tmp = _.with_suffix('.tmp')
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=4), encoding='utf-8')
+    os.replace(tmp, _)
 
-        log_q.put(f'[EMBEDDING] save to {embedding}')
-        _.save_local(embedding)
 
-        log_q.put(f'[EMBEDDING] COMPLETE')
+def chunk_ids(key: str, n: int):
+    return [f'{key}#{i}' for i in range(n)]
+
+
+def scan(load: str):
+    files = {}
+    for subdir in os.listdir(load):
+        subdir = Path(load) / subdir
+        if not subdir.is_dir():
+            continue
+        for _ in os.listdir(subdir.as_posix()):
+            if not _.endswith('.part'):
+                files[f'{subdir.name}/{_}'] = subdir / _
+    return files
+
+
+def diff(files: dict, manifest: dict):
+    changed, removed = [], [_ for _ in manifest if _ not in files]
+    for key, filename in files.items():
+        stat = filename.stat()
+        entry = manifest.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+
+        sha256 = file_digest(filename.as_posix())
+        if entry is not None and entry['sha256'] == sha256:
+            entry['mtime'] = stat.st_mtime
+            continue
+
+        changed.append((key, dict(size=stat.st_size, mtime=stat.st_mtime, sha256=sha256)))
+        if entry is not None:
+            removed.append(key)
+    return changed, removed
+
+
+def deduplicate(files: dict, manifest: dict, changed: list, removed: list, library: Library):
+    for key in removed:
+        if key not in files:
+            library.remove(key)
+
+    gone = {key for key, _ in changed} | set(removed)
+    stale = lambda _: any(k in gone or manifest.get(k, {}).get('sha256') != v for k, v in _.get('owners', {}).items())
+    while len(_ := [key for key, entry in manifest.items() if key in files and key not in gone and stale(entry)]) > 0:
+        for key in _:
+            entry = manifest[key]
+            changed.append((key, dict(size=entry['size'], mtime=entry['mtime'], sha256=entry['sha256'])))
+            removed.append(key)
+            gone.add(key)
+
+    keys = {key for key, _ in changed}
+    owners = {key for key, _ in manifest.items() if key in files and key not in keys and 'duplicate' not in _}
+    for key, entry in manifest.items():
+        if key in files and key not in keys and 'duplicate' in entry and entry['duplicate'] not in owners:
+            changed.append((key, dict(size=entry['size'], mtime=entry['mtime'], sha256=entry['sha256'])))
+            removed.append(key)
+
+    for key, entry in changed:
+        library.add(key, entry['sha256'])
+
+    unique, duplicates = [], {}
+    for key, entry in changed:
+        if (_ := next((_ for _ in library.aliases(key) if _ in owners), None)) is not None:
+            duplicates[key] = dict(entry, chunks=0, duplicate=_)
+        else:
+            owners.add(key)
+            unique.append((key, entry))
+    return unique, duplicates
+
+
+class Shard:
+    def __init__(self, path: str, embeddings: Embeddings, index_params: dict, metrics: Metrics = None):
+        self.path = path
+        self.category = Path(path).name
+        self.embeddings = embeddings
+        self.index_params = index_params
+        self.index = None
+        self.rows = {}
+        self.tombstones = set()
+        self.added, self.deleted = [], []
+        self.compacted = False
+        self.docs, self.ids, self.pending = [], [], []
+        self.modified = False
+        self.metrics = Metrics() if metrics is None else metrics
+
+    def load(self, manifest: dict, log_q: Queue):
+        with self.metrics.timer('load', 0, self.size()) as _:
+            self.index = ann.stable(faiss.read_index((Path(self.path) / 'index.faiss').as_posix()))
+            if not {'text', 'chunks_text'} <= self.schema():
+                self.migrate()
+            db = self.connect()
+            self.rows = dict(db.execute('SELECT position, id FROM chunks'))
+            self.tombstones = set(self.read_tombstones(db).tolist())
+            stamp = self.read_stamp(db)
+            db.close()
+            _['items'] = self.index.ntotal
+        if (_ := ann.kind_of(self.index)) != self.index_params.get('type', 'flat'):
+            log_q.put(f'[EMBEDDING] keep existing {_} index, delete {self.path} to rebuild as another type')
+
+        if stamp != self.index_stat():
+            _ = sorted(set(ann.ids(self.index).tolist()) - set(self.rows) - self.tombstones)
+            if len(_) > 0:
+                if log_q is not None:
+                    log_q.put(f'[EMBEDDING] remove {len(_)} vectors of an interrupted save from {self.path}')
+                self.remove(_)
+
+        _ = [i for i, _ in self.rows.items() if _.rpartition('#')[0] not in manifest]
+        if len(_) > 0:
+            self.remove(_)
+
+    def read_chunks(self):
+        if 'text' not in self.schema():
+            with open(Path(self.path) / 'index.pkl', 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            return [(i, _, (doc := docstore.search(_)).metadata.get('title'), doc.metadata.get('tokens'),
+                     doc.page_content, None, None) for i, _ in sorted(index_to_docstore_id.items())]
+
+        db = self.connect()
+        _ = db.execute('SELECT position, id, title, tokens, text, NULL, NULL FROM chunks ORDER BY position').fetchall()
+        db.close()
+        return _
+
+    def read_tombstones(self, db: sqlite3.Connection):
+        if 'tombstones' not in self.schema():
+            return np.zeros(0, dtype='int64')
+        return np.array([_ for _, in db.execute('SELECT position FROM tombstones')], dtype='int64')
+
+    def read_stamp(self, db: sqlite3.Connection):
+        if 'info' not in self.schema():
+            return None
+        _ = db.execute("SELECT value FROM info WHERE key = 'index'").fetchone()
+        return None if _ is None else json.loads(_[0])
+
+    def migrate(self):
+        self.added = self.read_chunks()
+        _ = Path(self.path) / METADATA
+        tmp = _.with_suffix('.tmp')
+        tmp.unlink(missing_ok=True)
+        self.save_metadata(tmp.as_posix())
+        os.replace(tmp, _)
+        self.added = []
+
+    def remove(self, positions: list):
+        if not ann.remove(self.index, positions):
+            self.tombstones.update(positions)
+        for _ in positions:
+            self.rows.pop(_, None)
+        self.deleted += positions
+        self.modified = True
+
+    def next(self):
+        if isinstance(self.index, faiss.IndexHNSW):
+            return self.index.ntotal
+        return max([-1, *self.rows, *self.tombstones]) + 1
+
+    def flush(self, final: bool = False):
+        n = len(self.docs)
+        if n > 0:
+            texts = [_.page_content for _ in self.docs]
+            with self.metrics.timer('embed', n, sum(len(_) for _ in texts)):
+                vectors = self.embeddings.embed_documents(texts)
+            self.pending.append((list(self.docs), vectors, list(self.ids)))
+            self.docs.clear()
+            self.ids.clear()
+
+        if self.index is None and len(self.pending) > 0:
+            if final or sum([len(_[0]) for _ in self.pending]) >= ann.train_size(self.index_params):
+                _ = np.array(sum([_[1] for _ in self.pending], []), dtype='float32')
+                with self.metrics.timer('index.train', len(_)):
+                    self.index = ann.new_index(_, self.index_params)
+                (Path(self.path) / METADATA).unlink(missing_ok=True)
+
+        if self.index is not None:
+            for docs, vectors, ids in self.pending:
+                with self.metrics.timer('index.add', len(docs)):
+                    _ = self.next()
+                    positions = list(range(_, _ + len(docs)))
+                    ann.add(self.index, np.array(vectors, dtype='float32'), positions)
+                self.rows.update(zip(positions, ids))
+                self.added += [(i, _, doc.metadata.get('title'), doc.metadata.get('tokens'), doc.page_content,
+                                doc.metadata.get('digest'), doc.metadata.get('signature'))
+                               for i, _, doc in zip(positions, ids, docs)]
+                self.modified = True
+            self.pending.clear()
+        return n
+
+    def compact(self):
+        if len(self.tombstones) == 0 or len(self.tombstones) <= ann.COMPACT * self.index.ntotal:
+            return
+        with self.metrics.timer('compact', self.index.ntotal):
+            self.index = ann.compact(self.index, list(self.tombstones))
+            self.rows = dict(enumerate(self.rows[_] for _ in sorted(self.rows)))
+            self.tombstones.clear()
+            self.compacted = True
+
+    def save(self, manifest: dict, final: bool = False):
+        self.flush(final)
+        waiting = {_.rpartition('#')[0] for _ in self.ids + [_ for docs, vectors, ids in self.pending for _ in ids]}
+        _ = {k: v for k, v in manifest.items() if k.partition('/')[0] == self.category and k not in waiting}
+        if len(_) == 0 and final:
+            shutil.rmtree(self.path, ignore_errors=True)
+        elif self.index is not None and (self.modified or final):
+            self.compact()
+            with self.metrics.timer('save', self.index.ntotal) as metrics:
+                os.makedirs(self.path, exist_ok=True)
+                tmp = Path(self.path) / 'index.faiss.tmp'
+                faiss.write_index(self.index, tmp.as_posix())
+                os.replace(tmp, Path(self.path) / 'index.faiss')
+                metrics['bytes'] = self.size()
+            with self.metrics.timer('save.metadata', len(self.added) + len(self.deleted)):
+                self.save_metadata()
+            (Path(self.path) / 'index.pkl').unlink(missing_ok=True)
+            save_manifest(self.path, _)
+            self.modified = False
+        elif self.index is None and final and all(v.get('chunks', 0) == 0 for v in _.values()):
+            save_manifest(self.path, _)
+
+    def size(self):
+        return sum(_.stat().st_size for _ in (Path(self.path) / 'index.faiss', Path(self.path) / METADATA)
+                   if _.exists())
+
+    def save_metadata(self, filename: str = None):
+        db = sqlite3.connect(filename or (Path(self.path) / METADATA).as_posix())
+        db.execute('CREATE TABLE IF NOT EXISTS chunks (position INTEGER PRIMARY KEY, id TEXT NOT NULL, '
+                   'title TEXT NOT NULL, tokens INTEGER, text TEXT NOT NULL, digest BLOB, signature BLOB)')
+        for _ in {'digest', 'signature'} - {_ for _, in db.execute("SELECT name FROM pragma_table_info('chunks')")}:
+            db.execute(f'ALTER TABLE chunks ADD COLUMN {_} BLOB')
+        db.execute('CREATE INDEX IF NOT EXISTS chunks_title ON chunks (title)')
+        db.execute('CREATE TABLE IF NOT EXISTS tombstones (position INTEGER PRIMARY KEY)')
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_text USING fts5(text, content='', "
+                   "tokenize='unicode61 remove_diacritics 2')")
+        db.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if (Path(self.path) / 'index.faiss').exists():
+            db.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('index', ?)", [json.dumps(self.index_stat())])
+
+        if len(self.deleted) > 0:
+            _ = [json.dumps(self.deleted)]
+            db.execute("INSERT INTO chunks_text (chunks_text, rowid, text) SELECT 'delete', position, text "
+                       "FROM chunks WHERE position IN (SELECT value FROM json_each(?))", _)
+            db.execute('DELETE FROM chunks WHERE position IN (SELECT value FROM json_each(?))', _)
+        db.executemany('INSERT INTO chunks (position, id, title, tokens, text, digest, signature) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)', self.added)
+        db.executemany('INSERT INTO chunks_text (rowid, text) VALUES (?, ?)', [(_[0], _[4]) for _ in self.added])
+
+        if self.compacted:
+            db.execute('CREATE TEMP TABLE moved (position INTEGER PRIMARY KEY, new INTEGER NOT NULL)')
+            db.execute('INSERT INTO moved SELECT position, ROW_NUMBER() OVER (ORDER BY position) - 1 FROM chunks')
+            db.execute('UPDATE chunks SET position = -1 - '
+                       '(SELECT new FROM moved WHERE moved.position = chunks.position)')
+            db.execute('UPDATE chunks SET position = -1 - position')
+            db.execute('DROP TABLE moved')
+            db.execute('DELETE FROM tombstones')
+            db.execute("INSERT INTO chunks_text (chunks_text) VALUES ('delete-all')")
+            db.execute('INSERT INTO chunks_text (rowid, text) SELECT position, text FROM chunks')
+        else:
+            db.executemany('INSERT OR IGNORE INTO tombstones (position) VALUES (?)',
+                           [(_,) for _ in self.deleted if _ in self.tombstones])
+        if self.compacted or filename is not None:
+            db.execute("INSERT INTO chunks_text (chunks_text) VALUES ('optimize')")
+        db.commit()
+        db.close()
+        self.added, self.deleted, self.compacted = [], [], False
+
+    def open(self, retries: int = 1, wait: float = 0.5):
+        for retry in range(retries + 1):
+            stat = self.index_stat()
+            for flags in (faiss.IO_FLAG_MMAP | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0), faiss.IO_FLAG_MMAP, 0):
+                try:
+                    self.index = faiss.read_index((Path(self.path) / 'index.faiss').as_posix(),
+                                                  flags | faiss.IO_FLAG_READ_ONLY)
+                    break
+                except RuntimeError:
+                    if flags == 0:
+                        raise
+
+            if not {'text', 'chunks_text'} <= self.schema():
+                self.migrate()
+
+            db = self.connect()
+            self.tombstones = self.read_tombstones(db)
+            _ = self.read_stamp(db)
+            db.close()
+            if _ is None or _ == stat == self.index_stat():
+                return self
+            if retry < retries:
+                time.sleep(wait)
+        raise RuntimeError(f'{self.path} index and metadata do not match, it is being saved or the last build failed')
+
+    def index_stat(self):
+        _ = (Path(self.path) / 'index.faiss').stat()
+        return [_.st_ino, _.st_size, _.st_mtime_ns]
+
+    def connect(self):
+        return sqlite3.connect(f'file:{(Path(self.path) / METADATA).as_posix()}?mode=ro', uri=True)
+
+    def schema(self):
+        if not (Path(self.path) / METADATA).exists():
+            return set()
+        db = self.connect()
+        _ = {_[0] for _ in db.execute("SELECT name FROM sqlite_master "
+                                      "UNION SELECT name FROM pragma_table_info('chunks')")}
+        db.close()
+        return _
+
+    def documents(self, positions: list):
+        db = self.connect()
+        _ = {i: Document(page_content=text, metadata=dict(category=self.category, title=title, tokens=n))
+             for i, title, n, text in db.execute('SELECT position, title, tokens, text FROM chunks WHERE '
+                                                      'position IN (SELECT value FROM json_each(?))',
+                                                      [json.dumps(positions)])}
+        db.close()
+        return _
+
+    def fingerprints(self):
+        if 'digest' not in self.schema():
+            return []
+        db = self.connect()
+        _ = [(id, digest, None if signature is None else np.frombuffer(signature, dtype='uint32'))
+             for id, digest, signature in db.execute('SELECT id, digest, signature FROM chunks '
+                                                      'WHERE digest IS NOT NULL')]
+        db.close()
+        return _
+
+    def positions(self, title: str = None, titles: list = None):
+        if title is None and titles is None:
+            return None
+
+        sql, args = 'SELECT position FROM chunks WHERE 1', []
+        if title is not None:
+            _ = re.sub(r'([%_\\])', r'\\\1', title)
+            sql, args = sql + " AND title LIKE ? ESCAPE '\\'", args + [f'%{_}%']
+        if titles is not None:
+            sql, args = sql + ' AND title IN (SELECT value FROM json_each(?))', args + [json.dumps(list(titles))]
+
+        db = self.connect()
+        _ = np.array([_[0] for _ in db.execute(sql, args)], dtype='int64')
+        db.close()
+        return _
+
+    def search(self, vectors: np.ndarray, k: int, nprobe: int, efSearch: int, positions: np.ndarray = None):
+        distances, found = ann.search(self.index, vectors, k, nprobe, efSearch, positions, self.tombstones)
+        docs = self.documents(sorted({int(_) for _ in found.ravel() if _ >= 0}))
+        return [[(docs[i], d) for d, i in zip(*_) if i in docs] for _ in zip(distances, found)]
+
+    def lexical(self, matches: list, k: int, positions: np.ndarray = None):
+        sql = 'SELECT rowid, bm25(chunks_text) FROM chunks_text WHERE chunks_text MATCH ?'
+        if positions is not None:
+            sql += ' AND rowid IN (SELECT value FROM json_each(?))'
+        args = [] if positions is None else [json.dumps(positions.tolist())]
+
+        db = self.connect()
+        found = [[] if match is None else db.execute(sql + ' ORDER BY bm25(chunks_text) LIMIT ?',
+                                                     [match] + args + [k]).fetchall() for match in matches]
+        db.close()
+        docs = self.documents(sorted({i for _ in found for i, score in _}))
+        return [[(docs[i], score) for i, score in _] for _ in found]
+
+
+def metrics_path(embedding: str):
+    return (Path(embedding).parent / 'logs' / METRICS).as_posix()
+
+
+def build(message: dict, log_q: Queue):
+    metrics = None
+    try:
+        metrics = Metrics(log_q, message.get('metrics', metrics_path(message['embedding'])), 'build')
+        with metrics.profile(message.get('profile', None)):
+            _build(message, log_q, metrics)
     except Exception as e:
         log_q.put(f'[EMBEDDING] ERROR {e}')
+    finally:
+        if metrics is not None:
+            metrics.report()
+            metrics.close()
+
+
+def _build(message: dict, log_q: Queue, metrics: Metrics):
+    load = message['load']
+    embedding = message['embedding']
+    categories = message.get('categories', None)
+    workers = message.get('workers', os.cpu_count() or 1)
+    pool = message.get('pool', 'thread')
+    batch_size = message.get('batch_size', 256)
+    checkpoint = message.get('checkpoint', 300)
+    stop = message.get('stop', None)
+    texts_cache = message.get('texts', (Path(embedding).parent / 'texts').as_posix())
+    texts_limit = message.get('texts_limit', 2 << 30)
+    engine = message.get('engine', 'tika')
+    index_params = message.get('index', {'type': 'flat'})
+    chunk_params = dict(chunking.DEFAULTS, **message.get('chunking', {}))
+    dedup = chunking.Deduplicator(chunk_params['dedup'], chunk_params['threshold'])
+    cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+
+    log_q.put('[EMBEDDING] initialize')
+
+    if pool not in POOLS:
+        raise ValueError(f'unknown pool {pool}, expected one of {POOLS}')
+    if pool == 'process' and current_process().daemon:
+        log_q.put('[EMBEDDING] parse in threads, a daemon process cannot start a process pool')
+        pool = 'thread'
+
+    def convert():
+        if (Path(embedding) / 'index.faiss').exists() and categories is None:
+            log_q.put(f'[EMBEDDING] delete the single database in {embedding}, converted to one per category')
+            for _ in ('index.faiss', 'index.pkl', MANIFEST):
+                (Path(embedding) / _).unlink(missing_ok=True)
+
+    if (Path(embedding) / 'index.faiss').exists():
+        log_q.put(f'[EMBEDDING] convert {embedding} to one database per category, '
+                  f'the single database is kept until all categories are built')
+
+    with metrics.timer('scan') as _:
+        files = scan(load)
+        _['items'] = len(files)
+    manifest = {}
+    for _ in manifest_paths(embedding).values():
+        manifest.update(load_manifest(_))
+    mtimes = {key: _['mtime'] for key, _ in manifest.items()}
+    changed, removed = diff(files, manifest)
+    touched = {key.partition('/')[0] for key, _ in manifest.items() if _['mtime'] != mtimes[key]}
+
+    def touch(saved: set):
+        for category, path in manifest_paths(embedding).items():
+            if category in touched - saved:
+                save_manifest(path, {k: v for k, v in manifest.items() if k.partition('/')[0] == category})
+
+    library = Library((Path(load) / LIBRARY).as_posix())
+    changed, duplicates = deduplicate(files, manifest, changed, removed, library)
+    library.close()
+
+    if categories is not None:
+        selected = lambda _: _.partition('/')[0] in categories
+        changed = [_ for _ in changed if selected(_[0])]
+        removed = [_ for _ in removed if selected(_)]
+        duplicates = {k: v for k, v in duplicates.items() if selected(k)}
+
+    if dedup.mode != 'none':
+        rebuilt = {key for key, _ in changed} | set(removed)
+        with metrics.timer('dedup.seed') as _:
+            for path in shard_paths(embedding).values():
+                for id, digest, signature in Shard(path, None, {}).fingerprints():
+                    if (key := id.rpartition('#')[0]) in manifest and key not in rebuilt:
+                        dedup.add(key, digest, signature)
+            _['items'] = len(dedup.hashes)
+
+    log_q.put(f'[EMBEDDING] {len(files)} files, {len(changed)} new or changed, '
+              f'{len(set(removed) - set(files))} removed, {len(duplicates)} duplicates skipped')
+
+    if len(changed) == 0 and len(removed) == 0 and len(duplicates) == 0 and len(manifest) > 0:
+        log_q.put(f'[EMBEDDING] database is up to date')
+        touch(set())
+        convert()
+        log_q.put(f'[EMBEDDING] COMPLETE')
+        return
+
+    log_q.put('[EMBEDDING] load model')
+    with metrics.timer('model'):
+        embeddings = encoder.create(message.get('model', {}), cache)
+
+    shards = {}
+    for _ in [key for key, _ in changed] + removed + list(duplicates):
+        category = _.partition('/')[0]
+        if category not in shards:
+            shards[category] = Shard((Path(embedding) / category).as_posix(), embeddings, index_params, metrics)
+
+    for key in removed:
+        manifest.pop(key)
+
+    for shard in shards.values():
+        if (Path(shard.path) / 'index.faiss').exists():
+            shard.load(manifest, log_q)
+
+    manifest.update(duplicates)
+
+    def save(final: bool = False):
+        for shard in shards.values():
+            shard.save(manifest, final)
+
+    saved = time.time()
+    counting = True
+    entries = dict(changed)
+    filenames = [files[key].as_posix() for key, _ in changed]
+    sha256s = [_['sha256'] for key, _ in changed]
+    _ = parse_files(filenames, workers, pool, sha256s, texts_cache, engine, metrics, chunk_params)
+    for parsed, (key, texts) in enumerate(zip(entries, _)):
+        if stop is not None and stop.is_set():
+            log_q.put(f'[EMBEDDING] stop after {parsed} / {len(changed)} parsed')
+            break
+
+        _ = files[key]
+        shard = shards[_.parent.name]
+
+        progress.put(log_q, 'EMBEDDING', parsed + 1, len(changed))
+
+        if isinstance(texts, Exception):
+            log_q.put(f'[EMBEDDING] {parsed + 1} / {len(changed)} skip {_.parent.name} {_.name} {texts}')
+            continue
+
+        with metrics.timer('dedup', len(texts)):
+            texts, fingerprints, owners = dedup.filter(texts, key)
+
+        counts = [None] * len(texts)
+        if counting:
+            try:
+                counts = tokens.count(texts)
+            except Exception as e:
+                counting = False
+                log_q.put(f'[EMBEDDING] skip token counts, {e}')
+
+        shard.docs += [Document(page_content=t, metadata=dict(category=_.parent.name, title=_.name, tokens=n,
+                                                              digest=d, signature=None if s is None else s.tobytes()))
+                       for t, n, (d, s) in zip(texts, counts, fingerprints)]
+        shard.ids += chunk_ids(key, len(texts))
+        manifest[key] = dict(entries[key], chunks=len(texts))
+        if len(owners) > 0:
+            manifest[key]['owners'] = {_: manifest[_]['sha256'] for _ in owners}
+
+        log_q.put(f'[EMBEDDING] {parsed + 1} / {len(changed)} parsed {len(texts)} from {_.parent.name} {_.name}')
+
+        if len(shard.docs) >= batch_size:
+            log_q.put(f'[EMBEDDING] embedded {shard.flush()} texts')
+
+        if time.time() - saved > checkpoint:
+            log_q.put(f'[EMBEDDING] checkpoint {len(manifest)} files to {embedding}')
+            save()
+            metrics.report()
+            saved = time.time()
+
+    stopped = stop is not None and stop.is_set()
+    log_q.put(f'[EMBEDDING] save to {embedding}')
+    save(final=not stopped)
+    touch(set(shards))
+    for shard in shards.values():
+        if shard.index is None and len(shard.pending) > 0:
+            log_q.put(f'[EMBEDDING] {shard.category} needs {ann.train_size(index_params)} texts to train the index, '
+                      f'{sum(len(_[0]) for _ in shard.pending)} are embedded again on the next build')
+
+    if dedup.exact + dedup.near > 0:
+        log_q.put(f'[EMBEDDING] skip {dedup.exact + dedup.near} duplicate chunks ({dedup.exact} exact, '
+                  f'{dedup.near} near), embedded {dedup.kept}')
+
+    if _ := textcache.evict(texts_cache, texts_limit):
+        log_q.put(f'[EMBEDDING] evict {_} cached texts')
+
+    if stopped:
+        log_q.put(f'[EMBEDDING] STOPPED')
+        return
+
+    if len(shard_paths(embedding)) == 0:
+        raise RuntimeError(f'no documents found in {load}')
+
+    convert()
+    log_q.put(f'[EMBEDDING] COMPLETE')
+
+
+def shard_paths(embedding: str):
+    if not Path(embedding).is_dir():
+        return {}
+    return {_.name: _.as_posix() for _ in sorted(Path(embedding).iterdir()) if (_ / 'index.faiss').exists()}
+
+
+def manifest_paths(embedding: str):
+    if not Path(embedding).is_dir():
+        return {}
+    return {_.name: _.as_posix() for _ in sorted(Path(embedding).iterdir()) if (_ / MANIFEST).exists()}
+
+
+def shard_version(path: str):
+    return tuple(_.stat().st_mtime_ns if _.exists() else None
+                 for _ in (Path(path) / 'index.faiss', Path(path) / METADATA))
+
+
+def select_categories(categories: list, selected: list = None, year_low: int = None, year_high: int = None):
+    _ = [_ for _ in categories if selected is None or _ in selected]
+    if year_low is not None or year_high is not None:
+        _ = [_ for _ in _ if _.isdigit() and (year_low or 0) <= int(_) <= (year_high or 9999)]
+    return _
+
+
+def load_database(databases: dict, embedding: str, embeddings: Embeddings, message: dict,
+                  log_q: Queue = None, metrics: Metrics = None):
+    metrics = Metrics() if metrics is None else metrics
+    paths = shard_paths(embedding)
+    for category in list(databases):
+        if category not in paths:
+            databases.pop(category)
+
+    selected = select_categories(list(paths), message.get('categories', None), message.get('year_low', None),
+                                 message.get('year_high', None))
+    for category in selected:
+        version = shard_version(paths[category])
+        if category not in databases or databases[category][0] != version:
+            if log_q is not None:
+                log_q.put(f'[EMBEDDING] load database {category}')
+            with metrics.timer('open') as _:
+                shard = Shard(paths[category], embeddings, {}).open()
+                _.update(items=shard.index.ntotal, bytes=shard.size())
+            databases[category] = version, shard
+
+    if len(paths) == 0:
+        raise FileNotFoundError(f'no database in {embedding}')
+    return {_: databases[_][1] for _ in selected}
+
+
+def match_query(query: str, terms: int = 32):
+    _ = list(dict.fromkeys(re.findall(r'\w+', query.lower())))[:terms]
+    return ' OR '.join([f'"{_}"' for _ in _]) or None
+
+
+def keyword_titles(keyword: str = None, library: str = None):
+    if keyword is None:
+        return None
+
+    titles = {}
+    db = Library(library)
+    for path in db.paths(keyword):
+        category, _, name = path.partition('/')
+        titles.setdefault(category, []).append(name)
+    db.close()
+    return titles
+
+
+def fuse(rankings: list, k: int, c: int = 60):
+    scores, docs = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = doc.metadata.get('category'), doc.metadata.get('title'), doc.page_content
+            scores[key] = scores.get(key, 0) + 1 / (c + rank + 1)
+            docs.setdefault(key, doc)
+    return [(docs[_], scores[_]) for _ in sorted(scores, key=lambda _: -scores[_])[:k]]
+
+
+def aggregate(chunks: list, how: str = 'max', mmr: float = None, passages: int = 3):
+    if how not in AGGREGATES:
+        raise ValueError(f'unknown aggregate {how}, expected one of {AGGREGATES}')
+
+    papers = {}
+    for category, title, text, n, score in chunks:
+        _ = papers.setdefault((category, title), dict(category=category, title=title, score=0.0, passages=[]))
+        _['score'] = max(_['score'], score) if how == 'max' else _['score'] + score
+        _['passages'].append(dict(text=text, tokens=n, score=score))
+    papers = sorted(papers.values(), key=lambda _: -_['score'])
+
+    if mmr is not None and len(papers) > 1:
+        words = [set(re.findall(r'\w+', ' '.join(_['text'] for _ in paper['passages']).lower())) for paper in papers]
+        relevance = np.array([_['score'] for _ in papers])
+        relevance = (relevance - relevance.min()) / max(relevance.max() - relevance.min(), 1e-12)
+        similarity = np.zeros(len(papers))
+        selected, remaining = [], list(range(len(papers)))
+        while len(remaining) > 0:
+            i = max(remaining, key=lambda i: mmr * relevance[i] - (1 - mmr) * similarity[i])
+            selected.append(i)
+            remaining.remove(i)
+            for j in remaining:
+                similarity[j] = max(similarity[j], len(words[i] & words[j]) / max(len(words[i] | words[j]), 1))
+        papers = [papers[_] for _ in selected]
+
+    for _ in papers:
+        _['passages'] = _['passages'][:passages]
+    return papers
+
+
+def put_papers(log_q: Queue, chunks: list, message: dict, metrics: Metrics = None, **extra):
+    metrics = Metrics() if metrics is None else metrics
+    with metrics.timer('aggregate', len(chunks)):
+        papers = aggregate(chunks, message.get('aggregate', 'max'), message.get('mmr', None),
+                           message.get('passages', 3))
+
+    page = message.get('page', 20)
+    for i in range(0, max(len(papers), 1), page):
+        log_q.put(dict(extra, **{'related papers': papers[i:i + page], 'offset': i, 'total': len(papers),
+                                 'score': SCORES[message.get('mode', 'hybrid')]}))
+
+
+def query_database(shards: dict, embeddings: Embeddings, query: str, k: int = 100, nprobe: int = 32,
+                   efSearch: int = 128, title: str = None, keyword: str = None, library: str = None,
+                   metrics: Metrics = None, mode: str = 'hybrid'):
+    if mode not in MODES:
+        raise ValueError(f'unknown search mode {mode}, expected one of {MODES}')
+    metrics = Metrics() if metrics is None else metrics
+
+    def vectors():
+        with metrics.timer('encode', 1, len(query)):
+            return np.array([embeddings.embed_query(query)], dtype='float32')
+
+    return query_vectors(shards, vectors if mode != 'lexical' else None, k, nprobe, efSearch, title, keyword, library,
+                         metrics, [query] if mode != 'vector' else None)[0]
+
+
+def query_vectors(shards: dict, vectors, k: int = 100, nprobe: int = 32, efSearch: int = 128, title: str = None,
+                  keyword: str = None, library: str = None, metrics: Metrics = None, queries: list = None):
+    metrics = Metrics() if metrics is None else metrics
+    titles = keyword_titles(keyword, library)
+    if callable(vectors) and queries is None:
+        vectors = vectors()
+    n = len(queries) if queries is not None else len(vectors)
+    matches = None if queries is None else [match_query(_) for _ in queries]
+
+    def positions(shard: Shard):
+        with metrics.timer('filter') as _:
+            positions = shard.positions(title, None if titles is None else titles.get(shard.category, []))
+            _['items'] = shard.index.ntotal if positions is None else len(positions)
+        return positions
+
+    def dense(shard: Shard, positions: np.ndarray):
+        if positions is not None and len(positions) == 0:
+            return [[] for _ in range(n)]
+        with metrics.timer('search', n):
+            return shard.search(vectors, k, nprobe, efSearch, positions)
+
+    def lexical(shard: Shard, positions: np.ndarray):
+        if positions is not None and len(positions) == 0:
+            return [[] for _ in range(n)]
+        with metrics.timer('lexical', n):
+            return shard.lexical(matches, k, positions)
+
+    with ThreadPoolExecutor(max_workers=max(1, 2 * len(shards))) as pool:
+        filters = list(pool.map(positions, shards.values()))
+        lexical_found = None if queries is None else [pool.submit(lexical, *_) for _ in zip(shards.values(), filters)]
+        if callable(vectors):
+            vectors = vectors()
+        dense_found = None if vectors is None else list(pool.map(dense, shards.values(), filters))
+        lexical_found = None if lexical_found is None else [_.result() for _ in lexical_found]
+
+    results = []
+    with metrics.timer('merge', n):
+        for i in range(n):
+            rankings = [sorted(sum([_[i] for _ in found], []), key=lambda _: _[1])[:k]
+                        for found in (dense_found, lexical_found) if found is not None]
+            if len(rankings) > 1:
+                scored = fuse([[doc for doc, d in _] for _ in rankings], k)
+            elif dense_found is not None:
+                scored = [(doc, 1 - float(d) / 2) for doc, d in rankings[0]]
+            else:
+                scored = [(doc, -d) for doc, d in rankings[0]]
+            results.append([(_.metadata.get('category'), _.metadata.get('title'), _.page_content,
+                             _.metadata.get('tokens'), score) for _, score in scored])
+    return results
+
+
+def query_args(message: dict):
+    library = message.get('library', (Path(message['embedding']).parent / 'documents' / LIBRARY).as_posix())
+    return (message.get('k', 100), message.get('nprobe', 32), message.get('efSearch', 128),
+            message.get('title', None), message.get('keyword', None), library)
+
+
+def query_message(shards: dict, embeddings: Embeddings, message: dict, metrics: Metrics = None):
+    return query_database(shards, embeddings, message['query'], *query_args(message), metrics,
+                          message.get('mode', 'hybrid'))
 
 
 def search(message: dict, log_q: Queue):
+    metrics = None
     try:
-        query = message['query']
         embedding = message['embedding']
         cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+        metrics = Metrics(log_q, message.get('metrics', metrics_path(embedding)), 'search')
 
-        log_q.put('[EMBEDDING] load database')
-        db = FAISS.load_local(embedding, HuggingFaceEmbeddings(cache_folder=cache))
+        with metrics.profile(message.get('profile', None)):
+            log_q.put('[EMBEDDING] load database')
+            embeddings = None
+            if message.get('mode', 'hybrid') != 'lexical':
+                with metrics.timer('model'):
+                    embeddings = encoder.create(message.get('model', {}), cache)
+            shards = load_database({}, embedding, embeddings, message, None, metrics)
 
-        log_q.put('[EMBEDDING] search similar documents')
-        docs = db.similarity_search(query, 100)
-        docs = [(_.metadata.get('category'), _.metadata.get('title'), _.page_content) for _ in docs]
-        log_q.put({'related documents': docs})
+            log_q.put('[EMBEDDING] search similar documents')
+            put_papers(log_q, query_message(shards, embeddings, message, metrics), message, metrics)
 
         log_q.put(f'[EMBEDDING] COMPLETE')
     except Exception as e:
         log_q.put(f'[EMBEDDING] ERROR {e}')
+    finally:
+        if metrics is not None:
+            metrics.report()
+            metrics.close()
 
 
-def text_in_tokens(texts: list, tokens: int):
-    if len(texts) > 0:
-        enc = tiktoken.encoding_for_model('gpt-4')
-        text = texts[0]
-        n = len(enc.encode(text))
+def serve(search_q: Queue, log_q: Queue, busy=None):
+    cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+    embeddings, model = None, None
+    databases = {}
 
-        if len(texts) > 1:
-            for _ in texts[1:]:
-                if n > tokens:
-                    break
+    while (message := search_q.get()) is not None:
+        metrics = None
+        try:
+            embedding = message['embedding']
+            metrics = Metrics(log_q, message.get('metrics', metrics_path(embedding)), 'search')
 
-                text += '\n' + _
-                n += len(enc.encode(_))
+            with metrics.profile(message.get('profile', None)):
+                if message.get('mode', 'hybrid') != 'lexical' and (embeddings is None or
+                                                                   message.get('model', {}) != model):
+                    log_q.put('[EMBEDDING] load model')
+                    model = message.get('model', {})
+                    with metrics.timer('model'):
+                        embeddings = encoder.create(model, cache)
 
-        return text, n
-    return '', 0
+                shards = load_database(databases.setdefault(embedding, {}), embedding, embeddings, message, log_q,
+                                       metrics)
+
+                log_q.put('[EMBEDDING] search similar documents')
+                put_papers(log_q, query_message(shards, embeddings, message, metrics), message, metrics)
+
+            log_q.put(f'[EMBEDDING] COMPLETE')
+        except Exception as e:
+            log_q.put(f'[EMBEDDING] ERROR {e}')
+        finally:
+            if metrics is not None:
+                metrics.report()
+                metrics.close()
+            if busy is not None:
+                busy.clear()
+
+
+def search_batch(message: dict, log_q: Queue):
+    metrics = None
+    try:
+        embedding = message['embedding']
+        queries = message['queries']
+        batch_size = message.get('batch_size', 64)
+        mode = message.get('mode', 'hybrid')
+        if len(queries) == 0:
+            raise ValueError('no queries')
+        cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+        metrics = Metrics(log_q, message.get('metrics', metrics_path(embedding)), 'search')
+
+        with metrics.profile(message.get('profile', None)):
+            embeddings, vectors = None, None
+            if mode != 'lexical':
+                log_q.put('[EMBEDDING] load model')
+                with metrics.timer('model'):
+                    embeddings = encoder.create(message.get('model', {}), cache)
+            shards = load_database({}, embedding, embeddings, message, log_q, metrics)
+
+            if mode != 'lexical':
+                log_q.put(f'[EMBEDDING] encode {len(queries)} queries')
+                vectors = []
+                for i in range(0, len(queries), batch_size):
+                    with metrics.timer('encode', len(queries[i:i + batch_size]),
+                                       sum(len(_) for _ in queries[i:i + batch_size])):
+                        vectors += embeddings.embed_documents(queries[i:i + batch_size])
+                    progress.put(log_q, 'EMBEDDING', min(i + batch_size, len(queries)), len(queries))
+                vectors = np.array(vectors, dtype='float32')
+
+            log_q.put('[EMBEDDING] search similar documents')
+            _ = query_vectors(shards, vectors, *query_args(message), metrics, queries if mode != 'vector' else None)
+            for query, _ in zip(queries, _):
+                put_papers(log_q, _, message, metrics, query=query)
+
+        log_q.put(f'[EMBEDDING] COMPLETE')
+    except Exception as e:
+        log_q.put(f'[EMBEDDING] ERROR {e}')
+    finally:
+        if metrics is not None:
+            metrics.report()
+            metrics.close()
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from abc import abstractmethod
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.huggingface import DEFAULT_MODEL_NAME
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+DEFAULTS = dict(backend='torch', model=DEFAULT_MODEL_NAME, batch_size=32, threads=None)
+CONFIG = 'papaper.json'
+
+
+class SortedEmbeddings(Embeddings):
+    batch_size = 32
+
+    @abstractmethod
+    def encode(self, texts: list) -> np.ndarray:
+        pass
+
+    def batches(self, texts: list):
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    def embed_documents(self, texts: list):
+        vectors = [None] * len(texts)
+        for batch in self.batches(texts):
+            for i, _ in zip(batch, self.encode([texts[i] for i in batch])):
+                vectors[i] = _.tolist()
+        return vectors
+
+    def embed_query(self, text: str):
+        return self.encode([text])[0].tolist()
+
+
+class OnnxEmbeddings(SortedEmbeddings):
+    def __init__(self, session, tokenizer, pooling: str = 'mean', normalize: bool = True, batch_size: int = 32):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.pooling = pooling
+        self.normalize = normalize
+        self.batch_size = batch_size
+        self.inputs = {_.name for _ in self.session.get_inputs()}
+
+    @classmethod
+    def load(cls, filename: str, batch_size: int = 32, threads: int = None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        config = json.loads((Path(filename).parent / CONFIG).read_text(encoding='utf-8'))
+        tokenizer = Tokenizer.from_file((Path(filename).parent / 'tokenizer.json').as_posix())
+        tokenizer.enable_truncation(config['max_seq_length'])
+        tokenizer.enable_padding(pad_id=config['pad_id'], pad_token=config['pad_token'])
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        return cls(session, tokenizer, config['pooling'], config['normalize'], batch_size)
+
+    def encode(self, texts: list) -> np.ndarray:
+        _ = self.tokenizer.encode_batch(texts)
+        mask = np.array([_.attention_mask for _ in _], dtype='int64')
+        feed = {'input_ids': np.array([_.ids for _ in _], dtype='int64'), 'attention_mask': mask}
+        if 'token_type_ids' in self.inputs:
+            feed['token_type_ids'] = np.zeros_like(mask)
+        hidden = self.session.run(None, feed)[0]
+
+        if self.pooling == 'cls':
+            vectors = hidden[:, 0]
+        elif self.pooling == 'max':
+            vectors = np.where(mask[..., None] > 0, hidden, -np.inf).max(axis=1)
+        else:
+            vectors = (hidden * mask[..., None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+        if self.normalize:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.astype('float32')
+
+
+def export(model: str, cache: str, quantize: bool = False):
+    directory = Path(cache) / 'onnx' / model.replace('/', '_')
+    fp32, int8 = directory / 'model.onnx', directory / 'model.int8.onnx'
+
+    if not (directory / CONFIG).exists():
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        st = SentenceTransformer(model, cache_folder=cache, device='cpu')
+        transformer, pooling = st[0], st[1]
+
+        class Encoder(torch.nn.Module):
+            def __init__(self, _):
+                super().__init__()
+                self.model = _
+
+            def forward(self, input_ids, attention_mask):
+                return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+        os.makedirs(directory, exist_ok=True)
+        transformer.tokenizer.save_pretrained(directory.as_posix())
+        _ = transformer.tokenizer(['papaper'], return_tensors='pt')
+        axes = {0: 'batch', 1: 'sequence'}
+        torch.onnx.export(Encoder(transformer.auto_model.eval()), (_['input_ids'], _['attention_mask']),
+                          fp32.as_posix(), input_names=['input_ids', 'attention_mask'],
+                          output_names=['last_hidden_state'], opset_version=14,
+                          dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'last_hidden_state': axes})
+
+        config = dict(model=model, max_seq_length=st.max_seq_length,
+                      pooling='cls' if pooling.pooling_mode_cls_token else
+                      'max' if pooling.pooling_mode_max_tokens else 'mean',
+                      normalize=any(type(_).__name__ == 'Normalize' for _ in st),
+                      pad_id=transformer.tokenizer.pad_token_id, pad_token=transformer.tokenizer.pad_token)
+        (directory / CONFIG).write_text(json.dumps(config, indent=4), encoding='utf-8')
+
+    if quantize and not int8.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        _ = directory / 'model.int8.onnx.tmp'
+        quantize_dynamic(fp32.as_posix(), _.as_posix(), weight_type=QuantType.QInt8)
+        os.replace(_, int8)
+
+    return (int8 if quantize else fp32).as_posix()
+
+
+def create(params: dict, cache: str):
+    params = dict(DEFAULTS, **{k: v for k, v in (params or {}).items() if v is not None})
+    if params['backend'] == 'torch':
+        if params['threads']:
+            import torch
+
+            torch.set_num_threads(params['threads'])
+        return HuggingFaceEmbeddings(cache_folder=cache, model_name=params['model'],
+                                     encode_kwargs={'batch_size': params['batch_size']})
+    elif params['backend'] in ('onnx', 'onnx-int8'):
+        return OnnxEmbeddings.load(export(params['model'], cache, params['backend'] == 'onnx-int8'),
+                                   params['batch_size'], params['threads'])
+    else:
+        raise ValueError(f'unknown backend {params["backend"]}, expected one of {BACKENDS}')
+
+
+def compare(reference: Embeddings, candidate: Embeddings, texts: list, k: int = 10, queries: int = 100,
+            seed: int = 0):
+    a = np.array(reference.embed_documents(texts), dtype='float32')
+    b = np.array(candidate.embed_documents(texts), dtype='float32')
+    cosine = (a * b).sum(axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+    rng = np.random.default_rng(seed)
+    _ = [' '.join(texts[i].split()[:max(1, len(texts[i].split()) // 2)])
+         for i in rng.choice(len(texts), min(queries, len(texts)), replace=False)]
+    k = min(k, len(texts))
+    hits = []
+    for model, vectors in ((reference, a), (candidate, b)):
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+        hits.append(index.search(np.array(model.embed_documents(_), dtype='float32'), k)[1])
+
+    recall = np.mean([len(set(x) & set(y)) / k for x, y in zip(*hits)])
+    return dict(recall=float(recall), cosine=float(cosine.mean()), min_cosine=float(cosine.min()), k=k,
+                queries=len(_), texts=len(texts))
+
+
+def sample(embedding: str, n: int = 1000, seed: int = 0):
+    texts = []
+    for _ in sorted(Path(embedding).glob('*/metadata.sqlite3')):
+        with sqlite3.connect(f'{_.as_uri()}?mode=ro', uri=True) as db:
+            texts += [text for text, in db.execute('SELECT text FROM chunks WHERE text IS NOT NULL')]
+    rng = np.random.default_rng(seed)
+    return [texts[i] for i in rng.choice(len(texts), min(n, len(texts)), replace=False)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m papaper.encoder', description='Check that a backend retrieves '
+                                                                                 'the same top-k as the fp32 model.')
+    parser.add_argument('embedding', help='embedding directory to sample chunks from')
+    parser.add_argument('--backend', choices=BACKENDS, default='onnx-int8')
+    parser.add_argument('--reference', choices=BACKENDS, default='torch')
+    parser.add_argument('--model', default=DEFAULTS['model'])
+    parser.add_argument('--sample', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    cache = (Path(sys.executable).parent.parent / 'cache').as_posix()
+    texts = sample(args.embedding, args.sample)
+    if len(texts) == 0:
+        parser.error(f'no chunks in {args.embedding}')
+    reference = create(dict(backend=args.reference, model=args.model, threads=args.threads), cache)
+    candidate = create(dict(backend=args.backend, model=args.model, threads=args.threads), cache)
+    print(json.dumps(compare(reference, candidate, texts, args.k, args.queries), indent=4))
@@ -0,0 +1,76 @@
+import html
+import os
+import re
+import sys
+import time
+import warnings
+from pathlib import Path
+
+ENGINES = ('tika', 'pypdf', 'pdfminer')
+
+
+def tika(filename: str):
+    from tika import parser
+
+    content = parser.from_file(filename, xmlContent=True)['content'] or ''
+    content = content.partition('<body>')[2] or content
+    pages = re.split(r'<div class="page">', content)
+    return '\f'.join([html.unescape(re.sub(r'<[^>]*>', '', re.sub(r'</p>|<br\s*/?>', '\n', _)))
+                      for _ in pages[1:] or pages]).strip()
+
+
+def pypdf(filename: str):
+    from pypdf import PdfReader
+
+    return '\f'.join([_.extract_text() or '' for _ in PdfReader(filename).pages])
+
+
+def pdfminer(filename: str):
+    from pdfminer.high_level import extract_text
+
+    return extract_text(filename)
+
+
+def extract(filename: str, engine: str = 'tika'):
+    if engine not in ENGINES:
+        raise ValueError(f'unknown engine {engine}, expected one of {ENGINES}')
+
+    if engine != 'tika' and Path(filename).suffix.lower() == '.pdf':
+        try:
+            if len(content := globals()[engine](filename).strip()) > 0:
+                return content, engine
+        except ImportError:
+            raise
+        except Exception as e:
+            warnings.warn(f'{engine} failed on {filename}, fall back to tika: {e}', RuntimeWarning)
+
+    return tika(filename), 'tika'
+
+
+def extract_text(filename: str, engine: str = 'tika'):
+    return extract(filename, engine)[0]
+
+
+def compare(filenames: list, engines: tuple = ENGINES):
+    report = {}
+    for engine in engines:
+        failed, chars, size = 0, 0, 0
+        start = time.perf_counter()
+        for filename in filenames:
+            try:
+                chars += len(globals()[engine](filename))
+                size += os.path.getsize(filename)
+            except Exception:
+                failed += 1
+        seconds = time.perf_counter() - start
+
+        report[engine] = dict(files=len(filenames) - failed, failed=failed, chars=chars, seconds=seconds,
+                              files_per_second=(len(filenames) - failed) / seconds if seconds > 0 else 0,
+                              megabytes_per_second=size / seconds / (1 << 20) if seconds > 0 else 0)
+    return report
+
+
+if __name__ == '__main__':
+    _ = [_.as_posix() for _ in Path(sys.argv[1]).rglob('*.pdf')]
+    for engine, row in compare(_, tuple(sys.argv[2:]) or ENGINES).items():
+        print(engine, ' '.join([f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in row.items()]))
@@ -0,0 +1,89 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import Queue
+from pathlib import Path
+
+
+class Metrics:
+    def __init__(self, log_q: Queue = None, filename: str = None, name: str = 'build'):
+        self.log_q = log_q
+        self.name = name
+        self.run = f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.file = None
+
+    def write(self, event: dict):
+        if self.file is None and self.filename is not None:
+            os.makedirs(Path(self.filename).parent, exist_ok=True)
+            self.file = open(self.filename, 'a', encoding='utf-8')
+        if self.file is not None:
+            self.file.write(json.dumps(dict(run=self.run, time=time.time(), **event), ensure_ascii=False) + '\n')
+
+    def record(self, stage: str, seconds: float, items: int = 0, size: int = 0):
+        with self.lock:
+            _ = self.stages.setdefault(stage, dict(calls=0, seconds=0.0, items=0, bytes=0))
+            _['calls'] += 1
+            _['seconds'] += seconds
+            _['items'] += items or 0
+            _['bytes'] += size or 0
+            self.write(dict(stage=stage, seconds=seconds, items=items or 0, bytes=size or 0))
+
+    def merge(self, stages: dict):
+        for stage, _ in stages.items():
+            self.record(stage, _['seconds'], _['items'], _['bytes'])
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 0, size: int = 0):
+        _ = dict(items=items, bytes=size)
+        start = time.perf_counter()
+        yield _
+        self.record(stage, time.perf_counter() - start, _['items'], _['bytes'])
+
+    def summary(self):
+        with self.lock:
+            return {stage: dict(_, rate=_['items'] / _['seconds'] if _['seconds'] > 0 else None,
+                                throughput=_['bytes'] / _['seconds'] if _['seconds'] > 0 else None)
+                    for stage, _ in self.stages.items()}
+
+    def report(self):
+        _ = self.summary()
+        with self.lock:
+            self.write(dict(stage='summary', stages=_))
+            if self.file is not None:
+                self.file.flush()
+        if self.log_q is not None and len(_) > 0:
+            self.log_q.put({'metrics': _, 'run': self.run})
+        return _
+
+    @contextmanager
+    def profile(self, directory: str = None):
+        if directory is None:
+            yield None
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats((Path(directory) / f'{self.run}.prof').as_posix())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.filename = None
+
+
+def describe(summary: dict):
+    return ', '.join(f'{stage} {_["seconds"]:.2f}s' + (f' {_["rate"]:.1f}/s' if _['items'] and _['rate'] else '') +
+                     (f' {_["throughput"] / (1 << 20):.1f}MiB/s' if _['bytes'] and _['throughput'] else '')
+                     for stage, _ in summary.items())
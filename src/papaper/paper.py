@@ -1,7 +1,4 @@
-import json
 import os
-import re
-import warnings
 from datetime import datetime
 from multiprocessing import Queue
 from pathlib import Path
@@ -9,6 +6,9 @@ from pathlib import Path
 from scholarly import scholarly
 from scihub.util.download import SciHub
 
+from papaper import download
+from papaper.store import LIBRARY, Library, PaperStore, SearchCache
+
 
 def main(message: dict, log_q: Queue):
     try:
@@ -21,57 +21,29 @@ def main(message: dict, log_q: Queue):
         os.makedirs(save_in, exist_ok=True)
 
         metadata_json = save_in / f'{keyword}.json'
-        if metadata_json.exists():
-            metadata = json.loads(metadata_json.read_text(encoding='utf-8'))
-        else:
-            metadata = {}
+        metadata = PaperStore((save_in / f'{keyword}.sqlite3').as_posix())
+        if len(metadata) == 0 and metadata_json.exists():
+            metadata.import_json(metadata_json.as_posix())
+
+        library = Library((save_in / LIBRARY).as_posix())
 
         log_q.put('[PAPER] initialize')
         scihub = SciHub()
-        scholar = scholarly.search_pubs(keyword, year_low=datetime.now().year - n_years, year_high=datetime.now().year)
-
-        searched = sum([len(metadata[__]) for __ in metadata])
-        log_q.put(f'{searched} / {n_papers}')
-
-        while searched < n_papers:
-            try:
-                log_q.put('[PAPER] search next')
-                paper = next(scholar)
-                scholar.pub_parser.fill(paper)
-
-                pub_year = paper['bib']['pub_year']
-                title = paper['bib']['title']
-                filename = re.sub(r'[\\/:*?"<>|]+', '', title)
-
-                if pub_year not in metadata:
-                    metadata[pub_year] = {}
-
-                if title in metadata[pub_year]:
-                    log_q.put(f'[PAPER] skip {pub_year} {title}')
-                    metadata[pub_year][title].update(paper.copy())
-                else:
-                    metadata[pub_year][title] = paper.copy()
-
-                    try:
-                        log_q.put(f'[PAPER] try download {pub_year} {title}')
-                        url = scihub.search(paper['pub_url'])
-                        os.makedirs(save_in / pub_year, exist_ok=True)
-                        scihub.download(url, save_in / pub_year, filename + '.pdf')
-                        download = 'succeeded'
-                    except Exception as e:
-                        warnings.warn(f'SCIHUB {e}')
-                        download = 'failed'
-
-                    log_q.put(f'[PAPER] try download {download}')
-
-                    metadata[pub_year][title]['download'] = download
-
-                metadata_json.write_text(json.dumps(metadata, ensure_ascii=False, indent=4), encoding='utf-8')
-
-                searched = sum([len(metadata[_]) for _ in metadata])
-                log_q.put(f'[PAPER] {searched} / {n_papers}')
-            except Exception as e:
-                warnings.warn(f'SCHOLARLY {e}')
+        year_low, year_high = datetime.now().year - n_years, datetime.now().year
+        cache = SearchCache((save_in / f'{keyword}.sqlite3').as_posix(), f'{year_low}-{year_high}')
+        if cache.position > 0:
+            log_q.put(f'[PAPER] resume search from result {cache.position}')
+        scholar = download.resume(lambda _: scholarly.search_pubs(keyword, year_low=year_low, year_high=year_high,
+                                                                  start_index=_), cache.position)
+
+        download.run(scholar, scholar.pub_parser.fill, lambda _: scihub.search(_['pub_url']), metadata, save_in,
+                     n_papers, log_q, workers=message.get('workers', 4), retries=message.get('retries', 3),
+                     interval=message.get('interval', 1.0), library=library, keyword=keyword, cache=cache)
+
+        metadata.export_json(metadata_json.as_posix())
+        metadata.close()
+        library.close()
+        cache.close()
 
         log_q.put(f'[PAPER] COMPLETE')
     except Exception as e:
@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from multiprocessing import Queue
+from queue import Empty
+
+from papaper.metrics import describe
+
+
+def put(log_q: Queue, name: str, done: int, total: int):
+    log_q.put({'progress': name, 'done': done, 'total': total})
+
+
+class Progress:
+    def __init__(self, name: str, window: float = 30.0):
+        self.name = name
+        self.window = window
+        self.done = 0
+        self.total = 0
+        self.samples = deque()
+
+    def update(self, done: int, total: int, now: float = None):
+        now = time.time() if now is None else now
+        if done < self.done:
+            self.samples.clear()
+
+        self.done, self.total = done, total
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    @property
+    def rate(self):
+        if len(self.samples) < 2 or (_ := self.samples[-1][0] - self.samples[0][0]) <= 0:
+            return 0.0
+        return (self.samples[-1][1] - self.samples[0][1]) / _
+
+    @property
+    def eta(self):
+        return (self.total - self.done) / self.rate if self.rate > 0 else None
+
+    def __str__(self):
+        _ = f'[{self.name}] {self.done} / {self.total}'
+        if self.total > 0:
+            _ += f' {100 * self.done / self.total:.0f}%'
+        if self.rate > 0:
+            _ += f' {self.rate:.1f}/s ETA {time.strftime("%H:%M:%S", time.gmtime(self.eta))}'
+        return _
+
+
+class Channel:
+    def __init__(self, log_q: Queue, filename: str = None, lines: int = 1000, batch: int = 1000,
+                 interval: float = 0.25, max_bytes: int = 1 << 20, backups: int = 3):
+        self.log_q = log_q
+        self.lines = deque(maxlen=lines)
+        self.batch = batch
+        self.interval = interval
+        self.progress = {}
+        self.updated = 0.0
+        self.dirty = False
+        self.drained = 0
+
+        self.logger = logging.getLogger(f'papaper.{id(self)}')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if filename is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            _ = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+            _.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(_)
+
+    def drain(self):
+        lines, messages = [], []
+        for self.drained in range(self.batch):
+            try:
+                log = self.log_q.get(block=False)
+            except Empty:
+                break
+
+            if isinstance(log, dict) and 'progress' in log:
+                if (_ := log['progress']) not in self.progress:
+                    self.progress[_] = Progress(_)
+                self.progress[_].update(log['done'], log['total'])
+                self.dirty = True
+            elif isinstance(log, dict) and 'metrics' in log:
+                lines.append(_ := f'[METRICS] {log["run"]} {describe(log["metrics"])}')
+                self.logger.info(_)
+            elif isinstance(log, dict):
+                messages.append(log)
+            else:
+                lines.append(log)
+                self.logger.info(log)
+        else:
+            self.drained = self.batch
+
+        self.lines.extend(lines)
+        return lines, messages
+
+    def due(self):
+        if self.dirty and time.time() - self.updated >= self.interval:
+            self.dirty = False
+            self.updated = time.time()
+            return True
+        return False
+
+    def status(self):
+        return '\n'.join(str(_) for _ in self.progress.values() if _.done < _.total)
+
+    def close(self):
+        for _ in self.logger.handlers[:]:
+            _.close()
+            self.logger.removeHandler(_)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+from pathlib import Path
+
+
+def file_digest(filename: str):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while block := f.read(1 << 20):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def doi_of(paper: dict):
+    for _ in (paper.get('pub_url'), paper.get('eprint_url'), paper.get('bib', {}).get('doi')):
+        if isinstance(_, str) and (_ := re.search(r'10\.\d{4,9}/[^\s?#&]+', _)):
+            return _.group(0).rstrip('.').lower()
+    return None
+
+
+LIBRARY = 'library.sqlite3'
+
+
+class PaperStore:
+    def __init__(self, filename: str):
+        os.makedirs(Path(filename).parent, exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS papers ('
+                        'pub_year TEXT NOT NULL, title TEXT NOT NULL, doi TEXT, download TEXT, data TEXT NOT NULL, '
+                        'PRIMARY KEY (pub_year, title))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_title ON papers (title)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_doi ON papers (doi)')
+        self.db.commit()
+        self.n = self.db.execute('SELECT COUNT(*) FROM papers').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, key: tuple):
+        return self.db.execute('SELECT 1 FROM papers WHERE pub_year = ? AND title = ?', key).fetchone() is not None
+
+    def get(self, pub_year: str, title: str):
+        _ = self.db.execute('SELECT data, download FROM papers WHERE pub_year = ? AND title = ?',
+                            (pub_year, title)).fetchone()
+        if _ is None:
+            return None
+        paper = json.loads(_[0])
+        if _[1] is not None:
+            paper['download'] = _[1]
+        return paper
+
+    def find(self, title: str = None, doi: str = None):
+        if doi is not None:
+            _ = self.db.execute('SELECT pub_year, title FROM papers WHERE doi = ?', (doi,)).fetchall()
+        else:
+            _ = self.db.execute('SELECT pub_year, title FROM papers WHERE title = ?', (title,)).fetchall()
+        return [tuple(_) for _ in _]
+
+    def count(self, pub_year: str = None, download: str = None):
+        if pub_year is None and download is None:
+            return self.n
+        sql, args = 'SELECT COUNT(*) FROM papers WHERE 1', []
+        if pub_year is not None:
+            sql, args = sql + ' AND pub_year = ?', args + [pub_year]
+        if download is not None:
+            sql, args = sql + ' AND download = ?', args + [download]
+        return self.db.execute(sql, args).fetchone()[0]
+
+    def retryable(self):
+        _ = self.db.execute("SELECT pub_year, title, data FROM papers WHERE download IS NULL OR download = 'failed'")
+        return [(pub_year, title, json.loads(data)) for pub_year, title, data in _.fetchall()]
+
+    def put(self, pub_year: str, title: str, paper: dict, commit: bool = True):
+        paper = dict(paper)
+        download = paper.pop('download', None)
+        data = json.dumps(paper, ensure_ascii=False)
+
+        if (pub_year, title) in self:
+            self.db.execute('UPDATE papers SET doi = coalesce(?, doi), download = coalesce(?, download), data = ? '
+                            'WHERE pub_year = ? AND title = ?', (doi_of(paper), download, data, pub_year, title))
+        else:
+            self.db.execute('INSERT INTO papers (pub_year, title, doi, download, data) VALUES (?, ?, ?, ?, ?)',
+                            (pub_year, title, doi_of(paper), download, data))
+            self.n += 1
+        if commit:
+            self.db.commit()
+
+    def set_download(self, pub_year: str, title: str, download: str):
+        self.db.execute('UPDATE papers SET download = ? WHERE pub_year = ? AND title = ?', (download, pub_year, title))
+        self.db.commit()
+
+    def import_json(self, filename: str):
+        metadata = json.loads(Path(filename).read_text(encoding='utf-8'))
+        for pub_year in metadata:
+            for title in metadata[pub_year]:
+                self.put(pub_year, title, metadata[pub_year][title], commit=False)
+        self.db.commit()
+
+    def export_json(self, filename: str):
+        metadata = {}
+        for pub_year, title, download, data in self.db.execute(
+                'SELECT pub_year, title, download, data FROM papers ORDER BY rowid'):
+            metadata.setdefault(pub_year, {})[title] = json.loads(data)
+            if download is not None:
+                metadata[pub_year][title]['download'] = download
+
+        tmp = Path(filename).with_suffix('.tmp')
+        tmp.write_text(json.dumps(metadata, ensure_ascii=False, indent=4), encoding='utf-8')
+        os.replace(tmp, filename)
+
+
+def pub_key(paper: dict):
+    return f'{paper.get("bib", {}).get("pub_year", "")}\t{paper.get("bib", {}).get("title", "")}'
+
+
+class SearchCache:
+    def __init__(self, filename: str, query: str):
+        os.makedirs(Path(filename).parent, exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cursors (query TEXT PRIMARY KEY, position INTEGER NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pubs ('
+                        'query TEXT NOT NULL, key TEXT NOT NULL, raw TEXT, filled TEXT, PRIMARY KEY (query, key))')
+        self.db.commit()
+        self.query = query
+        _ = self.db.execute('SELECT position FROM cursors WHERE query = ?', (query,)).fetchone()
+        self.position = 0 if _ is None else _[0]
+
+    def close(self):
+        self.db.close()
+
+    def advance(self, n: int = 1):
+        self.position += n
+        self.db.execute('INSERT INTO cursors (query, position) VALUES (?, ?) '
+                        'ON CONFLICT (query) DO UPDATE SET position = excluded.position', (self.query, self.position))
+        self.db.commit()
+
+    def get(self, key: str):
+        _ = self.db.execute('SELECT raw, filled FROM pubs WHERE query = ? AND key = ?', (self.query, key)).fetchone()
+        return None if _ is None else tuple(None if _ is None else json.loads(_) for _ in _)
+
+    def put(self, key: str, raw: dict = None, filled: dict = None):
+        raw, filled = [None if _ is None else json.dumps(_, ensure_ascii=False) for _ in (raw, filled)]
+        self.db.execute('INSERT INTO pubs (query, key, raw, filled) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (query, key) DO UPDATE SET raw = coalesce(excluded.raw, raw), '
+                        'filled = coalesce(excluded.filled, filled)', (self.query, key, raw, filled))
+        self.db.commit()
+
+    def pending(self):
+        _ = self.db.execute('SELECT raw FROM pubs WHERE query = ? AND filled IS NULL AND raw IS NOT NULL',
+                            (self.query,))
+        return [json.loads(_) for _, in _.fetchall()]
+
+
+def normalize_title(title: str):
+    title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+
+
+class Library:
+    def __init__(self, filename: str):
+        os.makedirs(Path(filename).parent, exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS papers ('
+                        'path TEXT PRIMARY KEY, sha256 TEXT, doi TEXT, title TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_sha256 ON papers (sha256)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_doi ON papers (doi)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_title ON papers (title)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS keywords ('
+                        'path TEXT NOT NULL, keyword TEXT NOT NULL, PRIMARY KEY (path, keyword))')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def find(self, doi: str = None, title: str = None, sha256: str = None):
+        for column, value in (('doi', doi), ('title', normalize_title(title) if title else None), ('sha256', sha256)):
+            if value:
+                if _ := self.db.execute(f'SELECT path FROM papers WHERE {column} = ?', (value,)).fetchone():
+                    return _[0]
+        return None
+
+    def add(self, path: str, sha256: str = None, doi: str = None, title: str = None, keyword: str = None):
+        title = normalize_title(title) if title else None
+        self.db.execute('INSERT INTO papers (path, sha256, doi, title) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (path) DO UPDATE SET sha256 = coalesce(excluded.sha256, sha256), '
+                        'doi = coalesce(excluded.doi, doi), title = coalesce(excluded.title, title)',
+                        (path, sha256, doi, title))
+        if keyword is not None:
+            self.db.execute('INSERT OR IGNORE INTO keywords (path, keyword) VALUES (?, ?)', (path, keyword))
+        self.db.commit()
+
+    def remove(self, path: str):
+        self.db.execute('DELETE FROM papers WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM keywords WHERE path = ?', (path,))
+        self.db.commit()
+
+    def aliases(self, path: str):
+        _ = self.db.execute('SELECT b.path FROM papers a JOIN papers b ON b.path != a.path AND '
+                            '(b.sha256 = a.sha256 OR b.doi = a.doi OR b.title = a.title) WHERE a.path = ?', (path,))
+        return [_[0] for _ in _.fetchall()]
+
+    def paths(self, keyword: str):
+        return [_[0] for _ in self.db.execute('SELECT path FROM keywords WHERE keyword = ? ORDER BY path', (keyword,))]
+
+    def keywords(self, path: str):
+        return [_[0] for _ in self.db.execute('SELECT keyword FROM keywords WHERE path = ? ORDER BY keyword', (path,))]
@@ -0,0 +1,43 @@
+import gzip
+import os
+from pathlib import Path
+
+
+def cache_path(texts: str, sha256: str):
+    return Path(texts) / sha256[:2] / f'{sha256}.txt.gz'
+
+
+def get(texts: str, sha256: str):
+    _ = cache_path(texts, sha256)
+    try:
+        content = gzip.decompress(_.read_bytes()).decode('utf-8')
+    except (FileNotFoundError, OSError, EOFError):
+        return None
+
+    os.utime(_)
+    return content
+
+
+def put(texts: str, sha256: str, content: str):
+    _ = cache_path(texts, sha256)
+    os.makedirs(_.parent, exist_ok=True)
+    tmp = _.with_suffix(f'.{os.getpid()}.tmp')
+    tmp.write_bytes(gzip.compress(content.encode('utf-8')))
+    os.replace(tmp, _)
+
+
+def evict(texts: str, limit: int):
+    files = []
+    for _ in Path(texts).glob('*/*.txt.gz'):
+        stat = _.stat()
+        files.append((stat.st_mtime, stat.st_size, _))
+
+    total = sum([_[1] for _ in files])
+    evicted = 0
+    for mtime, size, _ in sorted(files):
+        if total <= limit:
+            break
+        _.unlink(missing_ok=True)
+        total -= size
+        evicted += 1
+    return evicted
@@ -0,0 +1,28 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def encoding(model: str = 'gpt-4'):
+    return tiktoken.encoding_for_model(model)
+
+
+def count(texts: list):
+    return [len(_) for _ in encoding().encode_ordinary_batch(texts)]
+
+
+def pack(texts: list, counts: list, tokens: int, separator: int = 1):
+    if None in counts:
+        _ = [i for i, n in enumerate(counts) if n is None]
+        counts = list(counts)
+        for i, n in zip(_, count([texts[i] for i in _])):
+            counts[i] = n
+
+    packed, n = [], 0
+    for text, _ in zip(texts, counts):
+        _ += separator if len(packed) > 0 else 0
+        if n + _ <= tokens:
+            packed.append(text)
+            n += _
+    return '\n'.join(packed), n
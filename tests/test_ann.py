@@ -0,0 +1,61 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('faiss')
+
+from papaper import ann  # noqa: E402
+
+
+@pytest.mark.parametrize('kind', ann.KINDS)
+def test_remove_keeps_positions(kind):
+    vectors = np.random.default_rng(0).normal(size=(500, 16)).astype('float32')
+    index = ann.new_index(vectors, dict(type=kind, nlist=4, m=4))
+    ann.add(index, vectors, list(range(500)))
+    assert ann.kind_of(index) == kind
+
+    removed = ann.remove(index, list(range(0, 500, 2)))
+    assert removed == (kind != 'hnsw')
+    assert index.ntotal == (500 if kind == 'hnsw' else 250)
+    excluded = None if removed else np.arange(0, 500, 2)
+
+    ann.add(index, vectors[:10], list(range(500, 510)))
+    _, found = ann.search(index, vectors[1::2][:50], 1, nprobe=4, efSearch=64, excluded=excluded)
+    if kind != 'ivfpq':
+        assert (found[:, 0] == np.arange(1, 100, 2)).all()
+    assert not np.isin(found, np.arange(0, 500, 2)).any()
+    _, found = ann.search(index, vectors[0:10:2], 1, nprobe=4, efSearch=64, excluded=excluded)
+    assert (found[:, 0] >= 500).all()
+
+
+def test_stable_and_compact():
+    vectors = np.random.default_rng(0).normal(size=(100, 16)).astype('float32')
+    flat = ann.stable(ann.faiss.IndexFlatL2(16))
+    ann.add(flat, vectors, list(range(100)))
+    assert ann.remove(flat, [3, 4]) and ann.ids(flat).tolist() == [_ for _ in range(100) if _ not in (3, 4)]
+
+    hnsw = ann.new_index(vectors, dict(type='hnsw'))
+    ann.add(hnsw, vectors, list(range(100)))
+    with pytest.raises(ValueError):
+        ann.add(hnsw, vectors[:1], [200])
+    hnsw = ann.compact(hnsw, list(range(50)))
+    _, found = hnsw.search(vectors[50:60], 1)
+    assert hnsw.ntotal == 50 and (found[:, 0] == np.arange(10)).all()
+
+
+def test_evaluate():
+    vectors = np.random.default_rng(0).normal(size=(500, 16)).astype('float32')
+    report = ann.evaluate(vectors, vectors[:20], 10, [dict(type='hnsw', efSearch=64)])
+    assert [_['type'] for _ in report] == ['flat', 'hnsw']
+    assert report[0]['recall'] == 1.0 and report[1]['recall'] > 0.5
+
+
+@pytest.mark.parametrize('kind', ann.KINDS)
+def test_search_with_positions_returns_full_k(kind):
+    vectors = np.random.default_rng(0).normal(size=(2000, 16)).astype('float32')
+    index = ann.new_index(vectors, dict(type=kind, nlist=32, m=4))
+    ann.add(index, vectors, list(range(2000)))
+
+    positions = np.arange(7, 2000, 97, dtype='int64')
+    _, found = ann.search(index, vectors[:3], 10, nprobe=1, efSearch=1, positions=positions)
+    assert found.shape == (3, 10)
+    assert set(found.ravel()) <= set(positions)
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('faiss')
+pytest.importorskip('pypdf')
+
+from papaper import bench, extract
+
+
+def test_write_pdf(tmp_path):
+    bench.write_pdf((tmp_path / 'a.pdf').as_posix(), [f'line {i} (x)' for i in range(100)], per_page=30)
+    _ = extract.extract_text((tmp_path / 'a.pdf').as_posix(), 'pypdf')
+    assert 'line 0 (x)' in _ and 'line 99 (x)' in _
+
+
+def test_run(tmp_path):
+    report = bench.run(tmp_path.as_posix(), files=4, words=300, years=2, model='hash', kinds=('flat', 'hnsw'),
+                       ks=(1, 10), n_queries=5)
+    assert sorted(_.name for _ in (tmp_path / 'documents').iterdir()) == ['2023', '2024']
+    assert report['stages']['chunking']['chunks'] > 4
+    for _ in ('extract', 'parse_file', 'embedding', 'index.hnsw', 'save.flat', 'open.hnsw',
+              'search.flat.k10', 'search.hnsw.k1.batch'):
+        assert report['stages'][_]['seconds'] >= 0
+    assert report['stages']['search.flat.k1']['items'] == 5
+
+    rows = bench.compare(report, report)
+    assert len(rows) > 0 and all(_[3] in (1.0, None) for _ in rows)
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip('langchain')
+
+from papaper import chunking
+
+
+def test_clean_drops_running_headers_and_page_numbers():
+    page = ['Journal of Arthroplasty 2021; 36: {}-110', 'Outcomes of the {} approach.', '', '{}']
+    content = '\f'.join('\n'.join(page).format(100 + i, approach, i)
+                         for i, approach in enumerate(['anterior', 'lateral', 'posterior', 'direct superior']))
+    _, removed = chunking.clean(content)
+    assert 'Journal' not in _ and '\n3\n' not in _
+    assert _.count('Outcomes of the') == 4
+    assert removed == 8
+
+    assert chunking.clean(content, repeats=5)[0].count('Journal') == 4
+
+
+def test_clean_keeps_tables():
+    content = '\n'.join(['Mean HHS by follow-up', 'HHS 1 year', '85.2 (7.1)', 'HHS 2 years', '87.9 (6.4)',
+                          'HHS 5 years', '88.1 (6.0)', 'HHS 10 years', '86.5 (8.3)', '12', '14', '2019'])
+    assert chunking.clean(content) == (content, 0)
+
+    pages = [['Hip International', f'Results of the {_} approach.', f'Table {i + 1} {_} complications', 'Dislocation',
+              str(12 + i), f'Infection after the {_} approach', str(4 + i), str(i + 1)]
+             for i, _ in enumerate(('anterior', 'lateral', 'posterior'))]
+    _, removed = chunking.clean('\f'.join('\n'.join(_) for _ in pages))
+    assert 'Hip International' not in _ and removed == 6
+    assert _.splitlines()[-4:] == ['Dislocation', '14', 'Infection after the posterior approach', '6']
+
+
+def test_split_prefers_sentence_boundaries():
+    _ = chunking.split('The first sentence is here. The second sentence follows it. A third one ends it.', 60, 0)
+    assert _ == ['The first sentence is here. The second sentence follows it.', 'A third one ends it.']
+
+
+def test_deduplicator():
+    base = ('This article is distributed under the terms of the Creative Commons Attribution License, '
+            'which permits unrestricted use, distribution, and reproduction in any medium provided')
+    other = 'Femoral stem subsidence was measured on standardized radiographs at one and two years.'
+
+    dedup = chunking.Deduplicator()
+    _ = dedup.filter([base, other, base.upper(), base.replace('medium', 'medium,') + ' the'], 'a')
+    assert _[0] == [base, other] and _[2] == []
+    assert (dedup.kept, dedup.exact, dedup.near) == (2, 1, 1)
+
+    kept, fingerprints, owners = dedup.filter([base + ' the', 'Cup inclination was within the safe zone.'], 'b')
+    assert kept == ['Cup inclination was within the safe zone.'] and owners == ['a']
+
+    seeded = chunking.Deduplicator()
+    seeded.add('b', *fingerprints[0])
+    _ = seeded.filter([kept[0].lower(), other], 'c')
+    assert _[0] == [other] and _[2] == ['b'] and seeded.kept == 1
+
+    dedup = chunking.Deduplicator('exact')
+    assert len(dedup.filter([base, base, base + ' the'])[0]) == 2
+
+    dedup = chunking.Deduplicator('none')
+    assert len(dedup.filter([base, base])[0]) == 2
+
+    with pytest.raises(ValueError):
+        chunking.Deduplicator('simhash')
@@ -0,0 +1,38 @@
+import io
+import json
+
+import pytest
+
+pytest.importorskip('faiss')
+
+from papaper import cli
+
+
+def test_json_lines():
+    out = io.StringIO()
+    log_q = cli.JsonLines(out)
+    log_q.put('[EMBEDDING] load model')
+    log_q.put({'progress': 'EMBEDDING', 'done': 1, 'total': 2})
+    assert not log_q.failed
+    log_q.put('[EMBEDDING] ERROR no database')
+    assert log_q.failed
+    assert [json.loads(_) for _ in out.getvalue().splitlines()] == [
+        {'log': '[EMBEDDING] load model'},
+        {'progress': 'EMBEDDING', 'done': 1, 'total': 2},
+        {'log': '[EMBEDDING] ERROR no database'},
+    ]
+
+
+def test_parser():
+    args = cli.parser().parse_args(['--save', 'save', 'search', '--queries', 'q.txt', '--categories', '2021, 2022',
+                                    '-k', '5'])
+    assert args.run is cli.search and args.queries == 'q.txt' and args.k == 5
+    assert cli.categories(args.categories) == ['2021', '2022']
+    assert cli.categories('') is None
+
+    with pytest.raises(SystemExit):
+        cli.main(['--save', 'save', 'search'])
+
+    assert cli.parser().parse_args(['--save', 'save', 'build', '--pool', 'process']).pool == 'process'
+    with pytest.raises(SystemExit):
+        cli.parser().parse_args(['--save', 'save', 'build', '--pool', 'fork'])
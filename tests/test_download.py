@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+import pytest
+
+from papaper import download
+from papaper.store import Library, PaperStore, SearchCache
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 64
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+    failures = {}
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requests.append((url.path, self.headers.get('Range')))
+
+        if url.path == '/scholar':
+            pubs = [{'bib': {'pub_year': '2021', 'title': name}, 'pub_url': f'https://doi.org/10.1000/{name}'}
+                    for name in parse_qs(url.query).get('names', ['good,flaky,html'])[0].split(',')]
+            self.reply(200, json.dumps(pubs).encode())
+        elif url.path == '/scihub':
+            name = parse_qs(url.query)['url'][0].rpartition('/')[2]
+            self.reply(200, f'http://{self.headers["Host"]}/{name}.pdf'.encode())
+        elif url.path == '/html.pdf':
+            self.reply(200, b'<html>captcha</html>')
+        elif self.failures.get(url.path, 0) > 0:
+            self.failures[url.path] -= 1
+            self.reply(503, b'')
+        elif (_ := self.headers.get('Range')) is not None:
+            offset = int(_[len('bytes='):-1])
+            self.reply(206, PDF[offset:], {'Content-Range': f'bytes {offset}-{len(PDF) - 1}/{len(PDF)}'})
+        else:
+            self.reply(200, PDF)
+
+
+@pytest.fixture
+def server():
+    Handler.requests.clear()
+    Handler.failures.clear()
+    _ = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=_.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{_.server_address[1]}'
+    _.shutdown()
+
+
+class Log(list):
+    def put(self, _):
+        self.append(_)
+
+
+def test_run(server, tmp_path):
+    Handler.failures['/flaky.pdf'] = 2
+    metadata = PaperStore((tmp_path / 'keyword.sqlite3').as_posix())
+
+    pubs = iter(json.loads(urlopen(f'{server}/scholar').read()))
+    resolve = lambda _: urlopen(f'{server}/scihub?url={_["pub_url"]}').read().decode()
+
+    download.run(pubs, lambda _: _.update(filled=True), resolve, metadata, tmp_path, 10, Log(),
+                 workers=2, retries=2, backoff=0.01, interval=0)
+
+    assert len(metadata) == 3
+    assert metadata.get('2021', 'good')['download'] == 'succeeded'
+    assert metadata.get('2021', 'flaky')['download'] == 'succeeded'
+    assert metadata.get('2021', 'html')['download'] == 'failed'
+    assert metadata.get('2021', 'good')['filled']
+    assert (tmp_path / '2021' / 'flaky.pdf').read_bytes() == PDF
+    assert not (tmp_path / '2021' / 'html.pdf').exists()
+
+    download.run(iter([]), None, resolve, metadata, tmp_path, 10, Log(), retries=0, interval=0)
+    assert len([_ for _ in Handler.requests if _[0] == '/html.pdf']) == 4
+
+
+def test_run_skips_library_duplicates(server, tmp_path):
+    library = Library((tmp_path / 'library.sqlite3').as_posix())
+    library.add('2020/good.pdf', 'sha256', '10.1000/good', 'good', 'other keyword')
+    (tmp_path / '2020').mkdir()
+    (tmp_path / '2020' / 'good.pdf').write_bytes(PDF)
+
+    metadata = PaperStore((tmp_path / 'keyword.sqlite3').as_posix())
+    pubs = iter(json.loads(urlopen(f'{server}/scholar?names=good,same,copy').read()))
+    resolve = lambda _: urlopen(f'{server}/scihub?url={_["pub_url"]}').read().decode()
+
+    download.run(pubs, lambda _: None, resolve, metadata, tmp_path, 10, Log(), workers=1, interval=0,
+                 library=library, keyword='keyword')
+
+    assert metadata.get('2021', 'good')['download'] == 'duplicate'
+    assert metadata.get('2021', 'same')['download'] == 'succeeded'
+    assert metadata.get('2021', 'copy')['download'] == 'duplicate'
+    assert sorted(_.name for _ in (tmp_path / '2021').iterdir()) == ['same.pdf']
+    assert library.keywords('2020/good.pdf') == ['keyword', 'other keyword']
+    assert library.keywords('2021/same.pdf') == ['keyword']
+    assert '/good.pdf' not in [_[0] for _ in Handler.requests]
+
+
+def test_resume_search(server, tmp_path):
+    names = [f'paper{i}' for i in range(25)]
+    pubs = [{'bib': {'pub_year': '2021', 'title': name}, 'pub_url': f'https://doi.org/10.1000/{name}'}
+            for name in names]
+    starts, filled, failed = [], [], []
+    resolve = lambda _: urlopen(f'{server}/scihub?url={_["pub_url"]}').read().decode()
+
+    def search_pubs(start: int):
+        starts.append(start)
+        return iter([dict(_, bib=dict(_['bib'])) for _ in pubs[start:]])
+
+    def fill(paper: dict):
+        filled.append(paper['bib']['title'])
+        if paper['bib']['title'] == 'paper3' and len(failed) == 0:
+            failed.append('paper3')
+            raise ConnectionError('fill')
+        paper['bib']['abstract'] = 'filled'
+
+    def run(n: int, query: str = '2021-2021'):
+        metadata = PaperStore((tmp_path / 'keyword.sqlite3').as_posix())
+        cache = SearchCache((tmp_path / 'keyword.sqlite3').as_posix(), query)
+        download.run(download.resume(search_pubs, cache.position), fill, resolve, metadata, tmp_path, n, Log(),
+                     workers=1, interval=0, cache=cache)
+        return metadata, cache
+
+    metadata, cache = run(12)
+    assert len(metadata) == 12 and cache.position == 13
+    assert filled == names[:13] and starts == [0]
+
+    filled.clear()
+    metadata, cache = run(15)
+    assert starts == [0, 10]
+    assert filled == ['paper3', 'paper13', 'paper14']
+    assert metadata.get('2021', 'paper3')['bib']['abstract'] == 'filled'
+
+    filled.clear()
+    metadata, cache = run(20, '2020-2021')
+    assert starts == [0, 10, 0]
+    assert filled == names[15:20] and cache.position == 20
+    assert cache.get('2021\tpaper0')[1]['bib']['abstract'] == 'filled'
+    assert cache.pending() == []
+
+
+def test_resume_partial_download(server, tmp_path):
+    filename = tmp_path / 'paper.pdf'
+    Path(f'{filename}.part').write_bytes(PDF[:1000])
+
+    download.download_file(f'{server}/paper.pdf', filename.as_posix())
+
+    assert filename.read_bytes() == PDF
+    assert Handler.requests == [('/paper.pdf', 'bytes=1000-')]
+
+
+def test_rate_limiter():
+    limiter = download.RateLimiter(0.05)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.wait('http://a.example/x')
+    limiter.wait('http://b.example/x')
+    assert 0.1 <= time.monotonic() - start < 0.5
@@ -0,0 +1,483 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+pytest.importorskip('langchain')
+
+from langchain.schema import Document
+
+from papaper import bench, embedding, extract
+
+
+class Log(list):
+    def put(self, _):
+        self.append(_)
+
+
+def test_match_query():
+    assert embedding.match_query('Trident-II shell, trident BRCA1') == '"trident" OR "ii" OR "shell" OR "brca1"'
+    assert embedding.match_query('?!') is None
+
+
+def test_fuse():
+    a, b, c = [Document(page_content=_, metadata=dict(category='2021', title='t')) for _ in 'abc']
+    assert [_ for _, score in embedding.fuse([[a, b, c]], 2)] == [a, b]
+    assert [_ for _, score in embedding.fuse([[a, b], [c, b]], 3)] == [b, a, c]
+    assert embedding.fuse([[a, b], [c, b]], 3)[0][1] == pytest.approx(2 / 62)
+
+
+def test_aggregate():
+    chunks = [('2021', 'a.pdf', 'hip stem', None, 0.5), ('2021', 'b.pdf', 'hip stem cemented', None, 0.4),
+              ('2021', 'b.pdf', 'hip cup', None, 0.3), ('2022', 'c.pdf', 'knee', None, 0.2)]
+    _ = embedding.aggregate(chunks, 'max')
+    assert [paper['title'] for paper in _] == ['a.pdf', 'b.pdf', 'c.pdf']
+    assert [passage['text'] for passage in _[1]['passages']] == ['hip stem cemented', 'hip cup']
+    assert [paper['title'] for paper in embedding.aggregate(chunks, 'sum')] == ['b.pdf', 'a.pdf', 'c.pdf']
+    assert [paper['title'] for paper in embedding.aggregate(chunks, 'max', mmr=0.3)] == ['a.pdf', 'c.pdf', 'b.pdf']
+    assert [paper['title'] for paper in embedding.aggregate(chunks, 'max', mmr=0.6)] == ['a.pdf', 'b.pdf', 'c.pdf']
+    _ = [(category, title, text, n, score - 1) for category, title, text, n, score in chunks]
+    assert [paper['title'] for paper in embedding.aggregate(_, 'max', mmr=0.3)] == ['a.pdf', 'c.pdf', 'b.pdf']
+    assert len(embedding.aggregate(chunks, 'max', passages=1)[1]['passages']) == 1
+    with pytest.raises(ValueError):
+        embedding.aggregate(chunks, 'mean')
+
+
+def test_put_papers():
+    log_q = Log()
+    chunks = [('2021', f'{i}.pdf', 'text', None, 1 / (i + 1)) for i in range(45)]
+    embedding.put_papers(log_q, chunks, {'page': 20}, query='q')
+    assert [(_['offset'], len(_['related papers'])) for _ in log_q] == [(0, 20), (20, 20), (40, 5)]
+    assert all(_['total'] == 45 and _['query'] == 'q' and _['score'] == 'rrf' for _ in log_q)
+
+    log_q.clear()
+    embedding.put_papers(log_q, [], {'mode': 'vector'})
+    assert log_q == [{'related papers': [], 'offset': 0, 'total': 0, 'score': 'similarity'}]
+
+
+def test_hybrid_search(tmp_path):
+    texts = [f'cemented femoral stem number {i} in total hip arthroplasty' for i in range(50)]
+    texts += ['Trident II acetabular shell with BRCA1 carriers']
+
+    shard = embedding.Shard((tmp_path / '2021').as_posix(), bench.HashEmbeddings(), {'type': 'flat'})
+    shard.docs = [Document(page_content=_, metadata=dict(category='2021', title=f'{i % 5}.pdf', tokens=None))
+                  for i, _ in enumerate(texts)]
+    shard.ids = embedding.chunk_ids('2021/a.pdf', len(texts))
+    shard.save({'2021/a.pdf': {}}, final=True)
+
+    shards = {'2021': embedding.Shard(shard.path, None, {}).open()}
+    _ = embedding.query_database(shards, None, 'trident brca1', 5, mode='lexical')
+    assert [_[2] for _ in _] == [texts[-1]]
+    _ = embedding.query_database(shards, None, 'trident', 5, title='0.pdf', mode='lexical')
+    assert [_[:4] for _ in _] == [('2021', '0.pdf', texts[-1], None)] and _[0][4] > 0
+    assert embedding.query_database(shards, None, 'trident', 5, title='1.pdf', mode='lexical') == []
+
+    shards = {'2021': embedding.Shard(shard.path, bench.HashEmbeddings(), {}).open()}
+    _ = embedding.query_database(shards, bench.HashEmbeddings(), 'BRCA1 acetabular shell', 3)
+    assert _[0][2] == texts[-1] and len(_) == 3 and _[0][4] == pytest.approx(2 / 61)
+    _ = embedding.query_database(shards, bench.HashEmbeddings(), texts[-1], 3, mode='vector')
+    assert _[0][2] == texts[-1] and _[0][4] == pytest.approx(1, abs=1e-5) and _[0][4] > _[1][4] >= 0
+    with pytest.raises(ValueError):
+        embedding.query_database(shards, bench.HashEmbeddings(), 'shell', 3, mode='bm25')
+
+
+def test_legacy_pickled_docstore(tmp_path):
+    from langchain.vectorstores import FAISS
+
+    texts = [f'acetabular cup {i}' for i in range(10)]
+    db = FAISS.from_texts(texts, bench.HashEmbeddings(), [dict(category='2021', title=f'{i}.pdf') for i in range(10)],
+                          embedding.chunk_ids('2021/a.pdf', 10))
+    db.save_local((tmp_path / '2021').as_posix())
+
+    shard = embedding.Shard((tmp_path / '2021').as_posix(), None, {}).open()
+    assert (tmp_path / '2021' / embedding.METADATA).exists()
+    assert [_[2] for _ in embedding.query_database({'2021': shard}, None, 'cup 3', 1, mode='lexical')] == [texts[3]]
+
+    (tmp_path / '2021' / embedding.METADATA).unlink()
+    shard = embedding.Shard((tmp_path / '2021').as_posix(), bench.HashEmbeddings(), {'type': 'flat'})
+    shard.load({'2021/a.pdf': {}}, None)
+    assert len(shard.rows) == 10
+    shard.save({'2021/a.pdf': {}}, final=True)
+    assert not (tmp_path / '2021' / 'index.pkl').exists()
+
+    shard = embedding.Shard((tmp_path / '2021').as_posix(), bench.HashEmbeddings(), {'type': 'flat'})
+    shard.load({'2021/a.pdf': {}}, None)
+    assert shard.rows[4] == '2021/a.pdf#4'
+    assert shard.documents([4])[4].page_content == texts[4]
+    assert shard.documents([4])[4].metadata == dict(category='2021', title='4.pdf', tokens=None)
+
+
+@pytest.mark.parametrize('kind', ['flat', 'hnsw'])
+def test_remove_keeps_positions(tmp_path, kind):
+    keys = [f'2021/{i}.pdf' for i in range(4)]
+    shard = embedding.Shard((tmp_path / '2021').as_posix(), bench.HashEmbeddings(), {'type': kind})
+    for key in keys:
+        shard.docs += [Document(page_content=f'{key} passage {j}', metadata=dict(title=key[5:], tokens=None))
+                       for j in range(5)]
+        shard.ids += embedding.chunk_ids(key, 5)
+    shard.save({_: {} for _ in keys}, final=True)
+    inode = os.stat(Path(shard.path) / embedding.METADATA).st_ino
+
+    shard = embedding.Shard(shard.path, bench.HashEmbeddings(), {'type': kind})
+    shard.load({_: {} for _ in keys[1:]}, None)
+    assert sorted(shard.rows) == list(range(5, 20))
+    assert shard.tombstones == (set(range(5)) if kind == 'hnsw' else set())
+    shard.save({_: {} for _ in keys[1:]}, final=True)
+
+    opened = embedding.Shard(shard.path, bench.HashEmbeddings(), {}).open()
+    _ = opened.search(np.array(bench.HashEmbeddings().embed_documents(['2021/0.pdf passage 1']), 'float32'), 20, 8,
+                      64)
+    assert len(_[0]) == 15 and all(doc.metadata['title'] != '0.pdf' for doc, d in _[0])
+    assert opened.documents([6])[6].page_content == '2021/1.pdf passage 1'
+    assert [doc.page_content for doc, score in opened.lexical(['"0 pdf"'], 20)[0]] == []
+    assert os.stat(Path(shard.path) / embedding.METADATA).st_ino == inode
+
+    shard = embedding.Shard(shard.path, bench.HashEmbeddings(), {'type': kind})
+    shard.load({keys[3]: {}}, None)
+    shard.save({keys[3]: {}}, final=True)
+    assert sorted(shard.rows) == (list(range(5)) if kind == 'hnsw' else list(range(15, 20)))
+    assert shard.index.ntotal == 5 and shard.tombstones == set()
+    opened = embedding.Shard(shard.path, bench.HashEmbeddings(), {}).open()
+    _ = opened.lexical([embedding.match_query('passage 2')], 5)[0]
+    assert sorted(doc.page_content for doc, score in _) == [f'2021/3.pdf passage {j}' for j in range(5)]
+    assert opened.documents([2])[2].page_content == '2021/3.pdf passage 2' if kind == 'hnsw' else True
+
+
+PARAGRAPHS = [' '.join(f'{word}{i}' for word in ('femoral', 'stem', 'subsidence', 'measured', 'radiographs', 'cemented',
+                                                  'cohort', 'revision', 'followup', 'outcome', 'acetabular', 'cup',
+                                                  'liner', 'polyethylene', 'wear', 'patients', 'harris', 'score'))
+              for i in range(6)]
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding.encoder, 'create', lambda *args: bench.HashEmbeddings())
+    monkeypatch.setattr(embedding.extract, 'extract', lambda filename, engine: (Path(filename).read_text(), engine))
+    monkeypatch.setattr(embedding.tokens, 'count', lambda texts: [None] * len(texts))
+
+    def _(files: dict, failed: bool = False, **message):
+        for key, paragraphs in files.items():
+            os.makedirs(tmp_path / 'documents' / key.partition('/')[0], exist_ok=True)
+            if paragraphs is None:
+                (tmp_path / 'documents' / key).unlink()
+            else:
+                (tmp_path / 'documents' / key).write_text('\n\n'.join(PARAGRAPHS[i] for i in paragraphs))
+
+        log_q = Log()
+        _ = dict(load=(tmp_path / 'documents').as_posix(), embedding=(tmp_path / 'embedding').as_posix(),
+                 texts=(tmp_path / 'texts').as_posix(), metrics=(tmp_path / 'metrics.jsonl').as_posix(), workers=1)
+        embedding.build(dict(_, **message), log_q)
+        assert any('ERROR' in _ for _ in log_q if isinstance(_, str)) == failed, log_q
+        manifest = {}
+        for _ in embedding.manifest_paths((tmp_path / 'embedding').as_posix()).values():
+            manifest.update(embedding.load_manifest(_))
+        return manifest, log_q
+
+    _.embedding = (tmp_path / 'embedding').as_posix()
+    return _
+
+
+def test_dedup_owners(build):
+    build({'2021/a.pdf': [0, 1]})
+    manifest, log_q = build({'2022/b.pdf': [1, 2]})
+    assert manifest['2022/b.pdf']['chunks'] == 1
+    assert manifest['2022/b.pdf']['owners'] == {'2021/a.pdf': manifest['2021/a.pdf']['sha256']}
+
+    manifest, log_q = build({'2023/c.pdf': [2, 3]})
+    assert manifest['2023/c.pdf']['chunks'] == 1 and list(manifest['2023/c.pdf']['owners']) == ['2022/b.pdf']
+
+    manifest, log_q = build({'2021/a.pdf': None})
+    assert sorted(manifest) == ['2022/b.pdf', '2023/c.pdf']
+    assert manifest['2022/b.pdf']['chunks'] + manifest['2023/c.pdf']['chunks'] == 3
+    assert all(set(_.get('owners', {})) <= set(manifest) for _ in manifest.values())
+
+    shards = embedding.load_database({}, build.embedding, None, {})
+    _ = embedding.query_database(shards, None, 'femoral1 femoral2 femoral3', 10, mode='lexical')
+    assert sorted(_[2] for _ in _) == PARAGRAPHS[1:4]
+
+
+def test_token_counts_are_optional(build, monkeypatch):
+    def count(texts):
+        raise ConnectionError('offline')
+
+    monkeypatch.setattr(embedding.tokens, 'count', count)
+    manifest, log_q = build({'2021/a.pdf': [0], '2021/b.pdf': [1]})
+    assert manifest['2021/a.pdf']['chunks'] == manifest['2021/b.pdf']['chunks'] == 1
+    assert len([_ for _ in log_q if isinstance(_, str) and 'skip token counts' in _]) == 1
+
+    shard = embedding.Shard(embedding.shard_paths(build.embedding)['2021'], None, {}).open()
+    assert [_.metadata['tokens'] for _ in shard.documents([0, 1]).values()] == [None, None]
+
+
+def test_scan_skips_partial_downloads(tmp_path):
+    (tmp_path / '2021').mkdir()
+    (tmp_path / '2021' / 'a.pdf').write_bytes(b'%PDF-')
+    (tmp_path / '2021' / 'b.pdf.part').write_bytes(b'%PDF-')
+    (tmp_path / 'library.sqlite3').write_bytes(b'')
+    assert embedding.scan(tmp_path.as_posix()) == {'2021/a.pdf': tmp_path / '2021' / 'a.pdf'}
+
+
+def test_process_pool_in_daemon(build, monkeypatch):
+    monkeypatch.setattr(embedding, 'current_process', lambda: type('Process', (), {'daemon': True})())
+    manifest, log_q = build({'2021/a.pdf': [0]}, pool='process')
+    assert manifest['2021/a.pdf']['chunks'] == 1
+    assert '[EMBEDDING] parse in threads, a daemon process cannot start a process pool' in log_q
+
+
+class Messages(list):
+    def get(self):
+        while callable(_ := self.pop(0)):
+            _()
+        return _
+
+
+def save_shard(path, texts: list, kind: str = 'flat'):
+    shard = embedding.Shard(path, bench.HashEmbeddings(), {'type': kind})
+    if (Path(path) / 'index.faiss').exists():
+        shard.load({'2021/a.pdf': {}}, None)
+    shard.docs = [Document(page_content=_, metadata=dict(category='2021', title='a.pdf', tokens=None)) for _ in texts]
+    shard.ids = embedding.chunk_ids('2021/a.pdf', len(texts))
+    shard.save({'2021/a.pdf': {}}, final=True)
+
+
+def test_serve(tmp_path, monkeypatch):
+    models = []
+    monkeypatch.setattr(embedding.encoder, 'create', lambda model, cache: models.append(model) or
+                        bench.HashEmbeddings())
+    path = (tmp_path / 'embedding' / '2021').as_posix()
+    save_shard(path, ['cemented femoral stem'])
+    message = dict(embedding=(tmp_path / 'embedding').as_posix(), query='femoral stem', mode='vector')
+
+    log_q, busy = Log(), threading.Event()
+    search_q = Messages([message, lambda: save_shard(path, ['uncemented femoral stem']), message,
+                         dict(message, model={'backend': 'onnx'}), dict(message, model={'backend': 'onnx'}), busy.set,
+                         dict(message, model={'backend': 'onnx'}, embedding=(tmp_path / 'missing').as_posix()), None])
+    embedding.serve(search_q, log_q, busy)
+    assert not busy.is_set()
+    assert models == [{}, {'backend': 'onnx'}]
+    assert log_q.count('[EMBEDDING] load database 2021') == 2
+    assert log_q.count('[EMBEDDING] COMPLETE') == 4
+    assert [_ for _ in log_q if isinstance(_, str) and 'ERROR' in _] == [
+        f'[EMBEDDING] ERROR no database in {(tmp_path / "missing").as_posix()}']
+
+    _ = [sorted(_['text'] for paper in _['related papers'] for _ in paper['passages'])
+         for _ in log_q if isinstance(_, dict) and 'related papers' in _]
+    assert _[0] == ['cemented femoral stem'] and _[1] == ['cemented femoral stem', 'uncemented femoral stem']
+
+
+def test_open_checks_index_matches_metadata(tmp_path, monkeypatch):
+    path = tmp_path / '2021'
+    save_shard(path.as_posix(), ['cemented femoral stem', 'acetabular cup'])
+    assert embedding.Shard(path.as_posix(), None, {}).open().index.ntotal == 2
+
+    waits = []
+    monkeypatch.setattr(embedding.time, 'sleep', waits.append)
+    shutil.copy(path / 'index.faiss', path / 'index.faiss.tmp')
+    os.replace(path / 'index.faiss.tmp', path / 'index.faiss')
+    with pytest.raises(RuntimeError):
+        embedding.Shard(path.as_posix(), None, {}).open()
+    assert waits == [0.5]
+
+    shard = embedding.Shard(path.as_posix(), None, {})
+    monkeypatch.setattr(embedding.time, 'sleep', lambda _: save_shard(path.as_posix(), ['polyethylene liner']))
+    assert shard.open().index.ntotal == 3
+
+
+class Stop:
+    def __init__(self, after: int):
+        self.after = after
+        self.calls = 0
+
+    def is_set(self):
+        self.calls += 1
+        return self.calls > self.after
+
+
+def test_stop_and_resume(build):
+    files = {f'2021/{i}.pdf': [i] for i in range(5)}
+    manifest, log_q = build(files, stop=Stop(2))
+    assert len(manifest) == 2 and '[EMBEDDING] STOPPED' in log_q
+
+    manifest, log_q = build({})
+    assert sorted(manifest) == sorted(files)
+    assert '[EMBEDDING] 5 files, 3 new or changed, 0 removed, 0 duplicates skipped' in log_q
+
+
+def test_stop_before_training(build):
+    files = {f'2021/{i}.pdf': [i] for i in range(5)}
+    index = {'type': 'ivf', 'train_size': 100, 'nlist': 2}
+    manifest, log_q = build(files, stop=Stop(2), index=index)
+    assert manifest == {} and not (Path(build.embedding) / '2021' / 'index.faiss').exists()
+    assert '[EMBEDDING] 2021 needs 100 texts to train the index, 2 are embedded again on the next build' in log_q
+
+    manifest, log_q = build({}, index=index)
+    assert sorted(manifest) == sorted(files)
+    assert embedding.Shard(embedding.shard_paths(build.embedding)['2021'], None, {}).open().index.ntotal == 5
+
+
+def test_categories(build):
+    manifest, log_q = build({'2021/a.pdf': [0], '2022/b.pdf': [1], '2023/c.pdf': [2]}, categories=['2021', '2022'])
+    assert sorted(manifest) == ['2021/a.pdf', '2022/b.pdf']
+    assert sorted(embedding.shard_paths(build.embedding)) == ['2021', '2022']
+
+    manifest, log_q = build({'2021/a.pdf': [3], '2023/c.pdf': [2]}, categories=['2023'])
+    assert manifest['2021/a.pdf']['chunks'] == 1 and '2023/c.pdf' in manifest
+    shards = embedding.load_database({}, build.embedding, None, {})
+    assert embedding.query_database(shards, None, 'femoral0', 5, mode='lexical')[0][0] == '2021'
+
+    shards = embedding.load_database({}, build.embedding, None, {'categories': ['2022', '2023']})
+    assert sorted(shards) == ['2022', '2023']
+    assert {_[0] for _ in embedding.query_database(shards, None, 'femoral0 femoral1 femoral2', 5, mode='lexical')} == {
+        '2022', '2023'}
+    shards = embedding.load_database({}, build.embedding, None, {'year_low': 2022, 'year_high': 2022})
+    assert sorted(shards) == ['2022']
+
+
+def test_remove_category(build, tmp_path):
+    build({'2021/a.pdf': [0], '2022/b.pdf': [1]})
+    shutil.rmtree(tmp_path / 'documents' / '2022')
+    manifest, log_q = build({})
+    assert sorted(manifest) == ['2021/a.pdf']
+    assert sorted(embedding.shard_paths(build.embedding)) == ['2021']
+    assert not (Path(build.embedding) / '2022').exists()
+
+
+def test_convert_single_database(build, tmp_path):
+    from langchain.vectorstores import FAISS
+
+    FAISS.from_texts(['legacy'], bench.HashEmbeddings(), [dict(category='2021', title='a.pdf')],
+                     embedding.chunk_ids('2021/a.pdf', 1)).save_local(build.embedding)
+    embedding.save_manifest(build.embedding, {'2021/a.pdf': {}})
+
+    manifest, log_q = build({'2021/a.pdf': [0], '2022/b.pdf': [1]}, categories=['2021'])
+    assert sorted(manifest) == ['2021/a.pdf']
+    assert (Path(build.embedding) / 'index.faiss').exists() and (Path(build.embedding) / 'index.pkl').exists()
+
+    manifest, log_q = build({})
+    assert sorted(manifest) == ['2021/a.pdf', '2022/b.pdf']
+    assert not any((Path(build.embedding) / _).exists() for _ in ('index.faiss', 'index.pkl', embedding.MANIFEST))
+
+    manifest, log_q = build({})
+    assert '[EMBEDDING] database is up to date' in log_q
+
+
+def test_diff(tmp_path):
+    bench.corpus((tmp_path / 'documents').as_posix(), 4, words=100, years=2)
+    files = embedding.scan((tmp_path / 'documents').as_posix())
+    changed, removed = embedding.diff(files, {})
+    assert sorted(key for key, _ in changed) == sorted(files) and removed == []
+    manifest = {key: dict(_, chunks=1) for key, _ in changed}
+    assert embedding.diff(files, manifest) == ([], [])
+
+    os.utime(files['2024/paper0.pdf'], (1e9, 1e9))
+    assert embedding.diff(files, manifest) == ([], [])
+    assert manifest['2024/paper0.pdf']['mtime'] == 1e9
+
+    files['2023/paper1.pdf'].write_bytes(files['2024/paper2.pdf'].read_bytes())
+    (files.pop('2024/paper2.pdf')).unlink()
+    changed, removed = embedding.diff(files, manifest)
+    assert [key for key, _ in changed] == ['2023/paper1.pdf']
+    assert sorted(removed) == ['2023/paper1.pdf', '2024/paper2.pdf']
+    assert changed[0][1]['sha256'] == manifest['2024/paper2.pdf']['sha256']
+
+
+def test_deduplicate(tmp_path):
+    bench.corpus((tmp_path / 'documents').as_posix(), 3, words=100, years=1)
+    shutil.copy(tmp_path / 'documents' / '2024' / 'paper0.pdf', tmp_path / 'documents' / '2024' / 'copy.pdf')
+    files = embedding.scan((tmp_path / 'documents').as_posix())
+    library = embedding.Library((tmp_path / 'library.sqlite3').as_posix())
+
+    changed, removed = embedding.diff(files, {})
+    changed, duplicates = embedding.deduplicate(files, {}, sorted(changed), removed, library)
+    assert [key for key, _ in changed] == ['2024/copy.pdf', '2024/paper1.pdf', '2024/paper2.pdf']
+    assert list(duplicates) == ['2024/paper0.pdf'] and duplicates['2024/paper0.pdf']['duplicate'] == '2024/copy.pdf'
+    manifest = dict(dict((key, dict(_, chunks=1)) for key, _ in changed), **duplicates)
+
+    (files.pop('2024/copy.pdf')).unlink()
+    changed, removed = embedding.diff(files, manifest)
+    changed, duplicates = embedding.deduplicate(files, manifest, changed, removed, library)
+    assert [key for key, _ in changed] == ['2024/paper0.pdf'] and duplicates == {}
+    assert sorted(removed) == ['2024/copy.pdf', '2024/paper0.pdf']
+    assert library.aliases('2024/paper0.pdf') == []
+    library.close()
+
+
+def test_build_corpus(build, tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding.extract, 'extract', extract.extract)
+    bench.corpus((tmp_path / 'documents').as_posix(), 6, words=300, years=2)
+    shutil.copy(tmp_path / 'documents' / '2024' / 'paper0.pdf', tmp_path / 'documents' / '2024' / 'copy.pdf')
+
+    manifest, log_q = build({}, engine='pypdf', workers=2)
+    assert len(manifest) == 7 and sum('duplicate' in _ for _ in manifest.values()) == 1
+    owner = next(_['duplicate'] for _ in manifest.values() if 'duplicate' in _)
+    total = lambda: sum(embedding.Shard(_, None, {}).open().index.ntotal
+                        for _ in embedding.shard_paths(build.embedding).values())
+    chunks = total()
+    assert chunks == sum(_['chunks'] for _ in manifest.values())
+
+    os.utime(tmp_path / 'documents' / '2023' / 'paper1.pdf', (1e9, 1e9))
+    manifest, log_q = build({}, engine='pypdf')
+    assert '[EMBEDDING] database is up to date' in log_q and manifest['2023/paper1.pdf']['mtime'] == 1e9
+
+    (tmp_path / 'documents' / owner).unlink()
+    manifest, log_q = build({}, engine='pypdf')
+    assert owner not in manifest and all('duplicate' not in _ for _ in manifest.values())
+    assert total() == chunks == sum(_['chunks'] for _ in manifest.values())
+
+    (tmp_path / 'documents' / '2023' / 'paper1.pdf').unlink()
+    (tmp_path / 'documents' / '2023' / 'paper3.pdf').write_bytes(
+        (tmp_path / 'documents' / '2024' / 'paper2.pdf').read_bytes())
+    manifest, log_q = build({}, engine='pypdf')
+    survivor = ({'2024/copy.pdf', '2024/paper0.pdf'} - {owner}).pop()
+    assert sorted(manifest) == sorted(['2023/paper3.pdf', '2023/paper5.pdf', '2024/paper2.pdf', '2024/paper4.pdf',
+                                       survivor])
+    assert {_.get('duplicate') for key, _ in manifest.items() if key in ('2023/paper3.pdf', '2024/paper2.pdf')} in (
+        {None, '2023/paper3.pdf'}, {None, '2024/paper2.pdf'})
+    assert all(set(_.get('owners', {})) <= set(manifest) for _ in manifest.values())
+    assert total() == sum(_['chunks'] for _ in manifest.values())
+
+
+@pytest.mark.parametrize('kind', ['flat', 'ivf', 'hnsw'])
+def test_crash_before_metadata(build, monkeypatch, kind):
+    index = {'type': kind, 'train_size': 1, 'nlist': 1}
+    build({'2021/a.pdf': [0, 1], '2021/b.pdf': [2, 3]}, index=index)
+
+    def crash(self, filename=None):
+        raise KeyboardInterrupt('killed')
+
+    with monkeypatch.context() as _:
+        _.setattr(embedding.Shard, 'save_metadata', crash)
+        with pytest.raises(KeyboardInterrupt):
+            build({'2021/c.pdf': [4, 5]}, index=index)
+
+    manifest, log_q = build({}, index=index)
+    assert sorted(manifest) == ['2021/a.pdf', '2021/b.pdf', '2021/c.pdf']
+    assert '[EMBEDDING] remove 2 vectors of an interrupted save from ' \
+           f'{embedding.shard_paths(build.embedding)["2021"]}' in log_q
+
+    shard = embedding.Shard(embedding.shard_paths(build.embedding)['2021'], None, {}).open()
+    ids = [_ for _ in embedding.ann.ids(shard.index).tolist() if _ not in set(shard.tombstones.tolist())]
+    assert len(ids) == len(set(ids)) == 6
+    _ = shard.search(np.array(bench.HashEmbeddings().embed_documents(PARAGRAPHS[2:3]), 'float32'), 1, 1, 64)
+    assert _[0][0][0].page_content == PARAGRAPHS[2] and _[0][0][0].metadata['title'] == 'b.pdf'
+
+
+def test_category_of_duplicates(build, monkeypatch):
+    build({'2022/b.pdf': [0, 1]})
+    manifest, log_q = build({'2021/a.pdf': [0, 1]})
+    assert manifest['2021/a.pdf']['duplicate'] == '2022/b.pdf'
+    assert sorted(embedding.shard_paths(build.embedding)) == ['2022']
+
+    models = []
+    monkeypatch.setattr(embedding.encoder, 'create', lambda *args: models.append(args) or bench.HashEmbeddings())
+    manifest, log_q = build({})
+    assert '[EMBEDDING] database is up to date' in log_q and models == []
+
+    manifest, log_q = build({'2022/b.pdf': None})
+    assert sorted(manifest) == ['2021/a.pdf'] and manifest['2021/a.pdf']['chunks'] == 2
+    assert sorted(embedding.shard_paths(build.embedding)) == ['2021']
+    assert not (Path(build.embedding) / '2022').exists()
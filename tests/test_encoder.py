@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+
+from papaper import bench, encoder
+
+
+class Hashed(encoder.SortedEmbeddings):
+    def __init__(self, batch_size: int = 4, noise: float = 0.0):
+        self.batch_size = batch_size
+        self.noise = noise
+        self.lengths = []
+        self.model = bench.HashEmbeddings()
+
+    def encode(self, texts: list):
+        self.lengths.append([len(_) for _ in texts])
+        _ = np.array(self.model.embed_documents(texts), dtype='float32')
+        return _ + np.random.default_rng(len(texts)).normal(0, self.noise, _.shape).astype('float32')
+
+
+def test_sorted_batches():
+    texts = [' '.join(['word'] * n) + f' {n}' for n in (5, 50, 1, 20, 3, 40, 7, 9, 30)]
+    model = Hashed()
+    assert np.allclose(model.embed_documents(texts), bench.HashEmbeddings().embed_documents(texts), atol=1e-6)
+    assert [len(_) for _ in model.lengths] == [4, 4, 1]
+    assert all(min(a) >= max(b) for a, b in zip(model.lengths, model.lengths[1:]))
+    assert np.allclose(model.embed_query(texts[0]), model.embed_documents(texts[:1])[0], atol=1e-6)
+
+
+def test_compare():
+    rng = np.random.default_rng(0)
+    words = [f'w{i}' for i in range(500)]
+    texts = [' '.join(rng.choice(words, 30)) for _ in range(200)]
+
+    _ = encoder.compare(bench.HashEmbeddings(), Hashed(), texts, k=10, queries=20)
+    assert _['recall'] == 1.0 and _['cosine'] > 0.999 and _['queries'] == 20
+
+    _ = encoder.compare(bench.HashEmbeddings(), Hashed(noise=1.0), texts, k=10, queries=20)
+    assert _['recall'] < 0.9 and _['cosine'] < 0.9
+
+
+def test_create_unknown():
+    with pytest.raises(ValueError):
+        encoder.create({'backend': 'cuda'}, '.')
+
+
+class Tokenizer:
+    def encode_batch(self, texts: list):
+        n = max(len(_.split()) for _ in texts) + 1
+        return [type('Encoding', (), dict(ids=[101] + [len(w) for w in _.split()] + [0] * (n - 1 - len(_.split())),
+                                          attention_mask=[1] * (1 + len(_.split())) + [0] * (n - 1 - len(_.split()))))
+                for _ in texts]
+
+
+class Session:
+    def __init__(self, inputs: tuple = ('input_ids', 'attention_mask')):
+        self.inputs = inputs
+        self.feeds = []
+
+    def get_inputs(self):
+        return [type('Input', (), dict(name=_)) for _ in self.inputs]
+
+    def run(self, outputs, feed: dict):
+        self.feeds.append(feed)
+        ids = feed['input_ids'].astype('float32')
+        hidden = np.stack([ids, 2 * ids], axis=-1)
+        hidden[feed['attention_mask'] == 0] = 1000
+        return [hidden]
+
+
+@pytest.mark.parametrize('pooling, expected', [('mean', [[112 / 6, 224 / 6], [109 / 3, 218 / 3]]),
+                                               ('max', [[101, 202], [101, 202]]),
+                                               ('cls', [[101, 202], [101, 202]])])
+def test_onnx_pooling(pooling, expected):
+    session = Session()
+    _ = encoder.OnnxEmbeddings(session, Tokenizer(), pooling, normalize=False).encode(['a bb ccc dddd e', 'abcdef ab'])
+    assert _.dtype == np.float32 and np.allclose(_, expected, rtol=1e-5)
+    assert set(session.feeds[0]) == {'input_ids', 'attention_mask'}
+
+
+def test_onnx_normalize_and_token_types():
+    session = Session(('input_ids', 'attention_mask', 'token_type_ids'))
+    model = encoder.OnnxEmbeddings(session, Tokenizer(), 'mean', normalize=True)
+    _ = np.array(model.embed_documents(['a bb ccc dddd e', 'abcdef abcdef']))
+    assert np.allclose(np.linalg.norm(_, axis=1), 1) and np.allclose(_[0], _[1])
+    assert all(not _['token_type_ids'].any() and _['token_type_ids'].shape == _['input_ids'].shape
+               for _ in session.feeds)
+    assert np.allclose(model.embed_query('abcdef abcdef'), _[1], atol=1e-6)
+
+
+def test_encode_is_abstract():
+    with pytest.raises(TypeError):
+        encoder.SortedEmbeddings()
@@ -0,0 +1,29 @@
+import pytest
+
+from papaper import extract
+
+
+def test_fallback_to_tika(tmp_path, monkeypatch):
+    filename = (tmp_path / 'a.pdf').as_posix()
+    monkeypatch.setattr(extract, 'tika', lambda _: 'from tika')
+    monkeypatch.setattr(extract, 'pypdf', lambda _: 'from pypdf')
+    assert extract.extract(filename, 'pypdf') == ('from pypdf', 'pypdf')
+
+    monkeypatch.setattr(extract, 'pypdf', lambda _: '  ')
+    assert extract.extract(filename, 'pypdf') == ('from tika', 'tika')
+
+    def broken(_):
+        raise ValueError('bad xref')
+
+    monkeypatch.setattr(extract, 'pdfminer', broken)
+    with pytest.warns(RuntimeWarning, match='pdfminer failed on .*a.pdf'):
+        assert extract.extract(filename, 'pdfminer') == ('from tika', 'tika')
+
+    def missing(_):
+        raise ImportError('No module named pdfminer')
+
+    monkeypatch.setattr(extract, 'pdfminer', missing)
+    with pytest.raises(ImportError):
+        extract.extract(filename, 'pdfminer')
+    with pytest.raises(ValueError):
+        extract.extract(filename, 'ocr')
@@ -0,0 +1,50 @@
+import json
+import queue
+
+import pytest
+
+from papaper.metrics import Metrics, describe
+
+
+def test_record_and_report(tmp_path):
+    log_q = queue.Queue()
+    metrics = Metrics(log_q, (tmp_path / 'logs' / 'metrics.jsonl').as_posix(), 'build')
+    metrics.record('embed', 2.0, 100, 4096)
+    with metrics.timer('embed', 50) as _:
+        _['bytes'] = 1024
+    metrics.merge({'split': dict(calls=1, seconds=0.5, items=10, bytes=2000)})
+
+    _ = metrics.report()
+    assert _['embed']['calls'] == 2 and _['embed']['items'] == 150 and _['embed']['bytes'] == 5120
+    assert _['split']['rate'] == 20.0
+    assert log_q.get_nowait() == {'metrics': _, 'run': metrics.run}
+    assert describe({'split': _['split']}) == 'split 0.50s 20.0/s 0.0MiB/s'
+    metrics.close()
+
+    events = [json.loads(_) for _ in (tmp_path / 'logs' / 'metrics.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [_['stage'] for _ in events] == ['embed', 'embed', 'split', 'summary']
+    assert all(_['run'] == metrics.run for _ in events)
+
+
+def test_profile(tmp_path):
+    metrics = Metrics()
+    with metrics.profile((tmp_path / 'profile').as_posix()):
+        sum(range(1000))
+    assert (tmp_path / 'profile' / f'{metrics.run}.prof').exists()
+    assert not (tmp_path / 'logs').exists()
+
+
+def test_parse_files(tmp_path):
+    pytest.importorskip('faiss')
+    pytest.importorskip('pypdf')
+    from papaper import bench, embedding
+
+    bench.write_pdf((tmp_path / 'a.pdf').as_posix(), ['alpha beta gamma'] * 100)
+    metrics = Metrics()
+    _ = list(embedding.parse_files([(tmp_path / 'a.pdf').as_posix(), (tmp_path / 'b.pdf').as_posix()], 2,
+                                   sha256s=['aa' * 32, 'bb' * 32], texts=(tmp_path / 'texts').as_posix(),
+                                   engine='pypdf', metrics=metrics))
+    assert isinstance(_[0], list) and isinstance(_[1], Exception)
+    assert metrics.stages['extract.pypdf']['calls'] == 1
+    assert metrics.stages['split']['items'] == len(_[0])
+    assert metrics.stages['cache.get']['calls'] == 2 and metrics.stages['cache.get']['items'] == 0
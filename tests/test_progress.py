@@ -0,0 +1,51 @@
+import queue
+
+from papaper import progress
+
+
+def test_progress_rate_and_eta():
+    _ = progress.Progress('EMBEDDING')
+    _.update(0, 100, now=0.0)
+    _.update(10, 100, now=5.0)
+    assert _.rate == 2.0
+    assert _.eta == 45.0
+    assert str(_) == '[EMBEDDING] 10 / 100 10% 2.0/s ETA 00:00:45'
+
+    _.update(0, 50, now=6.0)
+    assert _.rate == 0.0 and _.eta is None
+
+
+def test_channel_drains_in_batches(tmp_path):
+    log_q = queue.Queue()
+    for i in range(25):
+        log_q.put(f'[EMBEDDING] line {i}')
+        progress.put(log_q, 'EMBEDDING', i + 1, 30)
+    log_q.put({'related documents': [1]})
+
+    channel = progress.Channel(log_q, (tmp_path / 'logs' / 'papaper.log').as_posix(), lines=10, batch=20)
+    lines, messages = channel.drain()
+    assert channel.drained == 20 and len(lines) == 10 and messages == []
+    assert channel.progress['EMBEDDING'].done == 10
+
+    lines, messages = channel.drain()
+    assert len(lines) == 10 and channel.progress['EMBEDDING'].done == 20
+
+    lines, messages = channel.drain()
+    assert channel.drained == 11 and messages == [{'related documents': [1]}]
+    assert list(channel.lines) == [f'[EMBEDDING] line {i}' for i in range(15, 25)]
+    assert channel.status().startswith('[EMBEDDING] 25 / 30')
+
+    assert channel.due() and not channel.due()
+    channel.close()
+    assert 'line 24' in (tmp_path / 'logs' / 'papaper.log').read_text(encoding='utf-8')
+
+
+def test_channel_rotates_log_file(tmp_path):
+    log_q = queue.Queue()
+    for i in range(100):
+        log_q.put('x' * 100)
+
+    channel = progress.Channel(log_q, (tmp_path / 'papaper.log').as_posix(), max_bytes=1000, backups=2)
+    channel.drain()
+    channel.close()
+    assert sorted(_.name for _ in tmp_path.iterdir()) == ['papaper.log', 'papaper.log.1', 'papaper.log.2']
@@ -0,0 +1,61 @@
+import json
+
+from papaper.store import Library, PaperStore, doi_of, normalize_title
+
+
+def test_doi_of():
+    assert doi_of({'pub_url': 'https://doi.org/10.1016/J.ARTH.2021.01.002?via=x'}) == '10.1016/j.arth.2021.01.002'
+    assert doi_of({'pub_url': 'https://example.com/paper', 'bib': {}}) is None
+
+
+def test_put_count_exists(tmp_path):
+    store = PaperStore((tmp_path / 'keyword.sqlite3').as_posix())
+    store.put('2021', 'A', {'bib': {'title': 'A'}, 'pub_url': 'https://doi.org/10.1000/a'})
+    store.put('2022', 'B', {'bib': {'title': 'B'}})
+    store.set_download('2021', 'A', 'succeeded')
+    store.put('2021', 'A', {'bib': {'title': 'A', 'abstract': 'updated'}})
+
+    assert len(store) == 2
+    assert ('2021', 'A') in store
+    assert ('2022', 'A') not in store
+    assert store.count(pub_year='2021') == 1
+    assert store.count(download='succeeded') == 1
+    assert store.find(title='B') == [('2022', 'B')]
+    assert store.find(doi='10.1000/a') == [('2021', 'A')]
+    assert store.get('2021', 'A') == {'bib': {'title': 'A', 'abstract': 'updated'}, 'download': 'succeeded'}
+    store.close()
+
+    assert len(PaperStore((tmp_path / 'keyword.sqlite3').as_posix())) == 2
+
+
+def test_json_round_trip(tmp_path):
+    metadata = {'2021': {'A': {'bib': {'title': 'A'}, 'download': 'failed'}}, '2022': {'B': {'bib': {'title': 'B'}}}}
+    (tmp_path / 'keyword.json').write_text(json.dumps(metadata), encoding='utf-8')
+
+    store = PaperStore((tmp_path / 'keyword.sqlite3').as_posix())
+    store.import_json((tmp_path / 'keyword.json').as_posix())
+    store.export_json((tmp_path / 'export.json').as_posix())
+
+    assert json.loads((tmp_path / 'export.json').read_text(encoding='utf-8')) == metadata
+
+
+def test_library(tmp_path):
+    library = Library((tmp_path / 'library.sqlite3').as_posix())
+    library.add('2021/A.pdf', 'aa', '10.1000/a', 'A Study: of Things', 'k1')
+    library.add('2022/B.pdf', 'bb', None, 'Other', 'k1')
+    library.add('2022/A2.pdf', 'cc')
+    library.add('2021/A.pdf', keyword='k2')
+
+    assert normalize_title(' A  study of things? ') == 'a study of things'
+    assert library.find(title='a study of THINGS') == '2021/A.pdf'
+    assert library.find(doi='10.1000/a') == '2021/A.pdf'
+    assert library.find(sha256='bb') == '2022/B.pdf'
+    assert library.find(doi='10.1000/b', title='Unknown') is None
+    assert library.keywords('2021/A.pdf') == ['k1', 'k2']
+
+    library.add('2022/A2.pdf', title='A study of things')
+    assert library.aliases('2022/A2.pdf') == ['2021/A.pdf']
+
+    library.remove('2021/A.pdf')
+    assert library.aliases('2022/A2.pdf') == []
+    assert library.keywords('2021/A.pdf') == []
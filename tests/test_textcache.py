@@ -0,0 +1,27 @@
+import os
+import time
+
+from papaper import textcache
+
+
+def test_put_get(tmp_path):
+    assert textcache.get(tmp_path.as_posix(), 'ab' * 32) is None
+
+    textcache.put(tmp_path.as_posix(), 'ab' * 32, 'parsed text')
+    assert textcache.get(tmp_path.as_posix(), 'ab' * 32) == 'parsed text'
+    assert textcache.cache_path(tmp_path.as_posix(), 'ab' * 32).exists()
+
+
+def test_evict_least_recently_used(tmp_path):
+    for i, sha256 in enumerate(['aa' * 32, 'bb' * 32, 'cc' * 32]):
+        textcache.put(tmp_path.as_posix(), sha256, os.urandom(1000).hex())
+        _ = time.time() - 100 + i
+        os.utime(textcache.cache_path(tmp_path.as_posix(), sha256), (_, _))
+
+    textcache.get(tmp_path.as_posix(), 'aa' * 32)
+
+    size = textcache.cache_path(tmp_path.as_posix(), 'aa' * 32).stat().st_size
+    assert textcache.evict(tmp_path.as_posix(), 2 * size + 100) == 1
+    assert textcache.get(tmp_path.as_posix(), 'bb' * 32) is None
+    assert textcache.get(tmp_path.as_posix(), 'aa' * 32) is not None
+    assert textcache.get(tmp_path.as_posix(), 'cc' * 32) is not None
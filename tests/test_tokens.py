@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('tiktoken')
+
+from papaper import tokens  # noqa: E402
+
+
+def test_pack_fills_budget_in_relevance_order():
+    texts = ['a', 'b', 'c', 'd']
+    assert tokens.pack(texts, [5, 8, 3, 1], 10) == ('a\nc', 9)
+    assert tokens.pack(texts, [5, 8, 3, 1], 11) == ('a\nc\nd', 11)
+    assert tokens.pack(texts, [5, 8, 3, 1], 4) == ('c', 3)
+    assert tokens.pack(texts, [5, 8, 3, 1], 0) == ('', 0)
+    assert tokens.pack([], [], 100) == ('', 0)
+
+
+def test_pack_never_exceeds_budget():
+    counts = [7, 3, 9, 2, 2, 5, 1]
+    for budget in range(30):
+        text, n = tokens.pack([str(_) for _ in range(len(counts))], counts, budget)
+        assert n <= budget
+        assert n == sum([counts[int(_)] for _ in text.split('\n') if _]) + max(0, len(text.split('\n')) - 1) * (n > 0)